@@ -0,0 +1,170 @@
+"""
+@author Cem Uran <cemuran@gmail.com>
+Copyright (C) This program is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your option)
+any later version. This program is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+License for more details.
+"""
+import numpy as np
+import hashlib
+import errno
+import os
+import os.path
+
+
+class data_cache(object):
+    """
+    Content addressed on-disk cache for lead field matrices
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        @brief      { Cache object }
+
+        @param      self    The cache object
+        @param      args    The cache directory
+        @param      kwargs  The cache options
+        """
+        self.options = {'cache_dir': '../results/cache/',
+                        'p_cache_size': 2 ** 30,
+                        }
+        if args:
+            self.options['cache_dir'] = args[0]
+        self.options.update(kwargs)
+        self.cache_dir = self.options['cache_dir']
+        self.p_cache_size = self.options['p_cache_size']
+        if not os.path.exists(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError as exc:  # Guard against race condition
+                if exc.errno != errno.EEXIST:
+                    raise
+
+    def get_key(self, name, *args, **kwargs):
+        """
+        Hash the arrays and parameters a cached matrix depends on
+
+        @param      self    The cache object
+        @param      name    Name of the cached matrix
+        @param      args    Arrays (electrode positions, voxels, ...)
+        @param      kwargs  Parameters (conductivity, noise covariance, ...)
+
+        @return     { Hex digest }
+        """
+        key = hashlib.sha1(name.encode('utf-8'))
+        for arg in args:
+            arg = np.ascontiguousarray(arg)
+            key.update(str(arg.shape).encode('utf-8'))
+            key.update(str(arg.dtype).encode('utf-8'))
+            key.update(arg.tobytes())
+        for k in sorted(kwargs):
+            if isinstance(kwargs[k], np.ndarray):
+                arg = np.ascontiguousarray(kwargs[k])
+                key.update(('%s=%s%s;' % (k, arg.shape,
+                                          arg.dtype)).encode('utf-8'))
+                key.update(arg.tobytes())
+            else:
+                key.update(('%s=%r;' % (k, kwargs[k])).encode('utf-8'))
+        return name + '_' + key.hexdigest()
+
+    def get_fname(self, key):
+        """
+        Filename of a cache entry
+
+        @param      self  The cache object
+        @param      key   The key
+
+        @return     { Filename }
+        """
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def load(self, key):
+        """
+        Memory-maps a cached matrix and marks it as recently used
+
+        @param      self  The cache object
+        @param      key   The key
+
+        @return     { Read-only memmap or None if not cached }
+        """
+        fname = self.get_fname(key)
+        if not os.path.exists(fname):
+            return None
+        try:
+            matrix = np.load(fname, mmap_mode='r')
+            os.utime(fname, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return matrix
+
+    def save(self, key, matrix):
+        """
+        Writes a matrix to the cache and evicts the least recently used
+        entries beyond the size cap
+
+        @param      self    The cache object
+        @param      key     The key
+        @param      matrix  The matrix
+
+        @return     { None }
+        """
+        fname = self.get_fname(key)
+        tmp_fname = fname[:-4] + '.%d.tmp' % os.getpid()
+        with open(tmp_fname, 'wb') as f:
+            np.save(f, matrix)
+        os.rename(tmp_fname, fname)
+        self.evict(keep=fname)
+
+    def evict(self, keep=None):
+        """
+        Least recently used eviction down to p_cache_size bytes
+
+        @param      self  The cache object
+        @param      keep  Filename which is never evicted
+
+        @return     { None }
+        """
+        entries = []
+        for f in os.listdir(self.cache_dir):
+            if not f.endswith('.npy'):
+                continue
+            fname = os.path.join(self.cache_dir, f)
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fname))
+        total = sum([e[1] for e in entries])
+        for mtime, size, fname in sorted(entries):
+            if total <= self.p_cache_size:
+                break
+            if fname == keep:
+                continue
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+            total -= size
+
+    def cmp_cached(self, key, func, *args, **kwargs):
+        """
+        Loads the matrix for key or computes and stores it
+
+        @param      self    The cache object
+        @param      key     The key
+        @param      func    Function computing the matrix
+        @param      args    Arguments for func
+        @param      kwargs  Keyword arguments for func
+
+        @return     { Matrix }
+        """
+        matrix = self.load(key)
+        if matrix is None:
+            matrix = func(*args, **kwargs)
+            self.save(key, matrix)
+        else:
+            print 'Loaded from cache: ' + key
+        return matrix
@@ -10,6 +10,97 @@ License for more details.
 """
 import h5py
 import pickle as pc
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+class data_view(object):
+    """
+    Time windowed view of a (channel x time) recording, only the requested
+    time window is read from the underlying dataset
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        @brief      { Recording view }
+        
+        @param      self    The view object
+        @param      args    Dataset (h5py dataset, memmap or array)
+        @param      kwargs  t_offset: first column holding samples,
+                            p_gain: scaling (scalar or per channel) applied
+                            to the read windows,
+                            p_readahead: minimum number of samples per read
+        """
+        self.dataset = args[0]
+        self.t_offset = kwargs.get('t_offset', 0)
+        self.p_gain = kwargs.get('p_gain', 1.)
+        if np.ndim(self.p_gain) == 1:
+            self.p_gain = np.asarray(self.p_gain, dtype=float)[:, None]
+        self.flag_gain = bool(np.any(np.asarray(self.p_gain) != 1.))
+        self.p_readahead = kwargs.get('p_readahead', 0)
+        self.shape = (self.dataset.shape[0],
+                      self.dataset.shape[1] - self.t_offset)
+        self.ndim = 2
+        self.buf = None
+        self.buf_start = 0
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self[:, :]
+        return self[:, :].astype(dtype)
+
+    def read(self, t_start, t_stop):
+        """
+        Reads all channels for a time window, windows shorter than
+        p_readahead are extended and kept for the next call
+        
+        @param      self     The view object
+        @param      t_start  First sample
+        @param      t_stop   Last sample (exclusive)
+        
+        @return     { Window (n_ch x (t_stop - t_start)) }
+        """
+        if self.p_readahead > 0:
+            if self.buf is None or t_start < self.buf_start or \
+                    t_stop > self.buf_start + self.buf.shape[1]:
+                self.buf_start = t_start
+                t_end = min(max(t_stop, t_start + self.p_readahead),
+                            self.shape[1])
+                self.buf = self.dataset[:, self.t_offset + t_start:
+                                        self.t_offset + t_end]
+            block = self.buf[:, t_start - self.buf_start:
+                             t_stop - self.buf_start]
+        else:
+            block = self.dataset[:, self.t_offset + t_start:
+                                 self.t_offset + t_stop]
+        if self.flag_gain:
+            block = block * self.p_gain
+        return block
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        rows, cols = key
+        if isinstance(cols, (int, np.integer)):
+            if cols < 0:
+                cols += self.shape[1]
+            return self.read(cols, cols + 1)[:, 0][rows]
+        if isinstance(cols, slice) and cols.step in (None, 1):
+            t_start, t_stop, _ = cols.indices(self.shape[1])
+            return self.read(t_start, max(t_start, t_stop))[rows]
+        if isinstance(cols, slice):
+            cols = np.arange(*cols.indices(self.shape[1]))
+        cols = np.asarray(cols)
+        if cols.dtype == bool:
+            cols = np.nonzero(cols)[0]
+        cols = np.where(cols < 0, cols + self.shape[1], cols)
+        if cols.shape[0] == 0:
+            return self.read(0, 0)[rows]
+        t_start = np.min(cols)
+        return self.read(t_start, np.max(cols) + 1)[:, cols - t_start][rows]
 
 
 class data_in(object):
@@ -27,10 +118,24 @@ class data_in(object):
         """
         self.f_name = args[0]
         self.flag_cell = kwargs.get('flag_cell')
+        self.flag_lazy = kwargs.get('flag_lazy', False)
+        self.p_rdcc_nbytes = kwargs.get('p_rdcc_nbytes', 2 ** 26)
+        self.p_readahead = kwargs.get('p_readahead', 0)
+        self.f = None
+        self.raw_options = None
         print args, kwargs
         print self.f_name
         print self.flag_cell
-        if self.flag_cell:
+        if kwargs.get('flag_raw'):
+            self.electrode_pos = kwargs['electrode_pos']
+            self.srate = kwargs['srate']
+            self.raw_options = {'p_nch': kwargs['p_nch'],
+                                'p_dtype': kwargs.get('p_dtype', 'int16'),
+                                'p_gain': kwargs.get('p_gain', 1.),
+                                'p_offset': kwargs.get('p_offset', 0)}
+            self.electrode_rec = self.load_raw_data(self.f_name,
+                                                    **self.raw_options)
+        elif self.flag_cell:
             (self.cell_pos_start, self.cell_pos, self.cell_pos_end,
              self.cell_csd, self.electrode_pos, self.electrode_rec,
              self.srate) = self.load_h5py_data(self.f_name, self.flag_cell)
@@ -38,9 +143,69 @@ class data_in(object):
             self.data_raw, self.srate = self.load_h5py_data(self.f_name,
                                                             self.flag_cell)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        """
+        Pickle support (e.g. for worker processes), recordings read through
+        a data_view are reopened from f_name instead of being copied
+        
+        @param      self  Data object
+        
+        @return     { State dictionary }
+        """
+        state = dict([(k, v) for k, v in self.__dict__.items()
+                      if not isinstance(v, data_view)])
+        state['f'] = None
+        return state
+
+    def __setstate__(self, state):
+        """
+        Restores a pickled data object and reopens its recordings
+        
+        @param      self   Data object
+        @param      state  The state dictionary
+        
+        @return     { None }
+        """
+        self.__dict__.update(state)
+        if self.raw_options is not None:
+            loaded = {'electrode_rec': self.load_raw_data(self.f_name,
+                                                          **self.raw_options)}
+        elif self.flag_lazy and self.flag_cell:
+            loaded = dict(zip(('cell_pos_start', 'cell_pos', 'cell_pos_end',
+                               'cell_csd', 'electrode_pos', 'electrode_rec',
+                               'srate'),
+                              self.load_h5py_data(self.f_name, True)))
+        elif self.flag_lazy:
+            loaded = dict(zip(('data_raw', 'srate'),
+                              self.load_h5py_data(self.f_name, False)))
+        else:
+            loaded = {}
+        for k in loaded:
+            if k not in state:
+                setattr(self, k, loaded[k])
+
+    def close(self):
+        """
+        Closes the file kept open in lazy mode
+        
+        @param      self  Data object
+        
+        @return     { None }
+        """
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
     def load_h5py_data(self, f_name, flag_cell):
         """
-        load h5py data optionally cell and electrode positions
+        load h5py data optionally cell and electrode positions, in lazy mode
+        the file is kept open and the recordings are read per time window
         
         @param      self       Data object
         @param      f_name     Filename
@@ -48,14 +213,62 @@ class data_in(object):
         
         @return     { Returns data }
         """
-        f = h5py.File(self.f_name, 'r')
-        print "Cell data avaliable"
-        if flag_cell:
-            return (f['cell'][:, 0:3], f['cell'][:, 3:6], f['cell'][:, 6:9],
-                    f['cell'][:, 9:], f['electrode'][:, 0:3],
-                    f['electrode'][:, 3:], f['srate'][()])
-        else:
-            return f['data'][:], f['srate'][()]
+        if self.flag_lazy:
+            self.f = h5py.File(self.f_name, 'r',
+                               rdcc_nbytes=self.p_rdcc_nbytes)
+            f = self.f
+            if flag_cell:
+                return (f['cell'][:, 0:3], f['cell'][:, 3:6],
+                        f['cell'][:, 6:9],
+                        data_view(f['cell'], t_offset=9,
+                                  p_readahead=self.p_readahead),
+                        f['electrode'][:, 0:3],
+                        data_view(f['electrode'], t_offset=3,
+                                  p_readahead=self.p_readahead),
+                        f['srate'][()])
+            else:
+                return (data_view(f['data'], p_readahead=self.p_readahead),
+                        f['srate'][()])
+        with h5py.File(self.f_name, 'r') as f:
+            print "Cell data avaliable"
+            if flag_cell:
+                return (f['cell'][:, 0:3], f['cell'][:, 3:6], f['cell'][:, 6:9],
+                        f['cell'][:, 9:], f['electrode'][:, 0:3],
+                        f['electrode'][:, 3:], f['srate'][()])
+            else:
+                return f['data'][:], f['srate'][()]
+
+    def load_raw_data(self, f_name, p_nch, p_dtype='int16', p_gain=1.,
+                      p_offset=0):
+        """
+        memory-map a flat channel-interleaved binary recording, the samples
+        are scaled only when a window is read
+        
+        @param      self      Data object
+        @param      f_name    Filename
+        @param      p_nch     Number of channels
+        @param      p_dtype   Sample type
+        @param      p_gain    Scaling to physical units (scalar or per channel)
+        @param      p_offset  Header size in bytes
+        
+        @return     { Recording view (n_ch x n_t) }
+        """
+        raw = np.memmap(f_name, dtype=p_dtype, mode='r', offset=p_offset)
+        n_t = raw.shape[0] // p_nch
+        return data_view(raw[:n_t * p_nch].reshape(n_t, p_nch).T,
+                         p_gain=p_gain)
+
+    def get_window(self, t_ind, t_int):
+        """
+        Recording window, in lazy mode only this window is read
+        
+        @param      self   Data object
+        @param      t_ind  First time point
+        @param      t_int  Number of time points
+        
+        @return     { Recording (n_el x t_int) }
+        """
+        return self.electrode_rec[:, t_ind:t_ind + t_int]
 
     def load_with_pickle(self, f_name):
         """
@@ -67,47 +280,398 @@ class data_in(object):
         @return     { None }
         """
 
-    def filter_bpass_data(self):
+    def get_rec(self):
         """
-        filter raw data
+        The recording used for pre-processing, electrode_rec if available
+        otherwise data_raw
         
         @param      self  Data object
         
-        @return     { None }
+        @return     { Recording (n_ch x n_t) }
         """
+        if hasattr(self, 'electrode_rec'):
+            return self.electrode_rec
+        return self.data_raw
 
-    def car_data(self):
+    def set_rec(self, rec):
         """
-        common average reference
+        Replaces the recording returned by get_rec
         
         @param      self  Data object
+        @param      rec   The recording
         
         @return     { None }
         """
+        if hasattr(self, 'electrode_rec'):
+            self.electrode_rec = rec
+        else:
+            self.data_raw = rec
 
-    def epoch_data(self):
+    def create_out_rec(self, p_suffix):
+        """
+        float memmap (n_ch x n_t) next to the source file for the result of
+        a pre-processing step, so recordings which are not in memory are not
+        copied to it
+        
+        @param      self      Data object
+        @param      p_suffix  Appended to f_name
+        
+        @return     { Memmap (n_ch x n_t) }
+        """
+        f_name = self.f_name + p_suffix
+        print "Writing to " + f_name
+        return np.memmap(f_name, dtype=float, mode='w+',
+                         shape=self.get_rec().shape)
+
+    def filter_bpass_data(self, p_low=300., p_high=3000., p_order=3,
+                          p_chunk=2 ** 16, p_workers=1, out=None):
+        """
+        filter raw data, zero-phase band-pass filter with second-order
+        sections. The forward and the backward pass run over time chunks
+        with the filter state carried between the chunks, the result equals
+        scipy.signal.sosfiltfilt.
+        
+        @param      self       Data object
+        @param      p_low      Lower cutoff frequency (Hz)
+        @param      p_high     Upper cutoff frequency (Hz)
+        @param      p_order    Butterworth filter order
+        @param      p_chunk    Number of time points per chunk
+        @param      p_workers  Number of threads over channel groups
+        @param      out        Float array or memmap (n_ch x n_t) for the
+                               result, may be the recording itself. If None
+                               an array for in-memory recordings, otherwise
+                               a memmap next to the source file.
+        
+        @return     { Filtered recording, also replaces the recording }
+        """
+        from scipy.signal import butter, sosfilt, sosfilt_zi
+        from multiprocessing.pool import ThreadPool
+        rec = self.get_rec()
+        n_ch, n_t = rec.shape
+        if out is None:
+            if type(rec) is np.ndarray:
+                out = np.empty((n_ch, n_t))
+            else:
+                out = self.create_out_rec('.filt.dat')
+        elif not np.issubdtype(out.dtype, np.floating):
+            # the backward pass reads the forward pass from out
+            raise ValueError('filter_bpass_data needs a float out, not %s'
+                             % out.dtype)
+        sos = butter(p_order, [p_low / (self.srate / 2.),
+                               p_high / (self.srate / 2.)],
+                     btype='band', output='sos')
+        zi = sosfilt_zi(sos)[:, None, :]
+        n_pad = 3 * (2 * sos.shape[0] + 1 -
+                     min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum()))
+        n_pad = min(n_pad, n_t - 1)
+        groups = np.array_split(np.arange(n_ch), max(p_workers, 1))
+        groups = [g for g in groups if g.shape[0] > 0]
+        if p_workers > 1:
+            pool = ThreadPool(p_workers)
+            pmap = pool.map
+        else:
+            pool = None
+            pmap = map
+        # Odd extensions at both ends (read before out may overwrite rec)
+        head = np.asarray(rec[:, :n_pad + 1], dtype=float)
+        tail = np.asarray(rec[:, n_t - n_pad - 1:], dtype=float)
+        head = 2 * head[:, :1] - head[:, n_pad:0:-1]
+        tail = 2 * tail[:, -1:] - tail[:, -2::-1]
+        state = [None] * len(groups)
+
+        def fwd_start(i):
+            g = groups[i]
+            state[i] = sosfilt(sos, head[g], axis=1,
+                               zi=zi * head[g, :1][None])[1]
+
+        def fwd_step(args):
+            i, block = args
+            y, state[i] = sosfilt(sos, block[groups[i]], axis=1, zi=state[i])
+            return y
+
+        def bwd_start(i):
+            g = groups[i]
+            y_tail = sosfilt(sos, tail[g], axis=1, zi=state[i])[0]
+            y_tail = y_tail[:, ::-1]
+            state[i] = sosfilt(sos, y_tail, axis=1,
+                               zi=zi * y_tail[:, :1][None])[1]
+
+        # Forward pass
+        pmap(fwd_start, range(len(groups)))
+        for t in range(0, n_t, p_chunk):
+            block = np.asarray(rec[:, t:t + p_chunk], dtype=float)
+            res = pmap(fwd_step, [(i, block) for i in range(len(groups))])
+            for i, g in enumerate(groups):
+                out[g[0]:g[-1] + 1, t:t + p_chunk] = res[i]
+        # Backward pass over the reversed forward output
+        pmap(bwd_start, range(len(groups)))
+        for t in range((n_t - 1) // p_chunk * p_chunk, -1, -p_chunk):
+            block = np.asarray(out[:, t:t + p_chunk])[:, ::-1]
+            res = pmap(fwd_step, [(i, block) for i in range(len(groups))])
+            for i, g in enumerate(groups):
+                out[g[0]:g[-1] + 1, t:t + p_chunk] = res[i][:, ::-1]
+        if pool is not None:
+            pool.close()
+        self.set_rec(out)
+        return out
+
+    def cmp_ref_groups(self, p_axis=0, p_tol=1.):
+        """
+        reference groups (shanks) of electrodes sharing the same coordinate
+        along p_axis
+        
+        @param      self    Data object
+        @param      p_axis  Coordinate axis separating the shanks
+        @param      p_tol   Coordinates closer than p_tol are the same shank
+        
+        @return     { List of channel index arrays }
+        """
+        pos = np.round(self.electrode_pos[:, p_axis] / p_tol)
+        shanks = np.unique(pos, return_inverse=True)[1]
+        return [np.nonzero(shanks == sh)[0] for sh in range(shanks.max() + 1)]
+
+    def car_data(self, p_method='mean', p_bad=None, flag_shank=False,
+                 p_axis=0, p_chunk=2 ** 16, out=None):
+        """
+        common average reference, subtracts the mean (or median) over the
+        good channels of each reference group from all channels of the group.
+        Works in time chunks computed in float, in place on writable
+        recordings (rounded for integer samples).
+        
+        @param      self        Data object
+        @param      p_method    'mean' or 'median'
+        @param      p_bad       Bad channels excluded from the reference
+        @param      flag_shank  Reference each shank separately
+        @param      p_axis      Coordinate axis separating the shanks
+        @param      p_chunk     Number of time points per chunk
+        @param      out         Array or memmap (n_ch x n_t) for the result,
+                                if None the recording itself if writable,
+                                otherwise a memmap next to the source file
+        
+        @return     { Re-referenced recording, also replaces the recording }
+        """
+        rec = self.get_rec()
+        n_ch, n_t = rec.shape
+        if out is None:
+            if isinstance(rec, np.ndarray) and rec.flags.writeable:
+                out = rec
+            else:
+                out = self.create_out_rec('.car.dat')
+        if flag_shank:
+            groups = self.cmp_ref_groups(p_axis)
+        else:
+            groups = [np.arange(n_ch)]
+        good = np.ones(n_ch, dtype=bool)
+        if p_bad is not None:
+            good[np.asarray(p_bad)] = False
+        for t in range(0, n_t, p_chunk):
+            block = np.array(rec[:, t:t + p_chunk], dtype=float)
+            for g in groups:
+                g_good = g[good[g]]
+                if g_good.shape[0] == 0:
+                    continue
+                if p_method == 'median':
+                    ref = np.median(block[g_good], axis=0)
+                else:
+                    ref = np.mean(block[g_good], axis=0)
+                block[g] -= ref
+            if np.issubdtype(out.dtype, np.integer):
+                info = np.iinfo(out.dtype)
+                block = np.clip(np.round(block), info.min, info.max)
+            out[:, t:t + p_chunk] = block.astype(out.dtype)
+        self.set_rec(out)
+        return out
+
+    def epoch_data(self, p_thresh=5., p_pre=10, p_post=20, p_dt=5,
+                   p_radius=20., p_tmad=2 ** 17, p_chunk=2 ** 16,
+                   flag_negative=True):
         """
         threshold to get spike time points (can be overwritten)
+        Channels cross a robust threshold of p_thresh*MAD/0.6745, the event
+        time is the peak within p_dt samples after the crossing. Events
+        within p_dt samples on electrodes closer than p_radius are merged
+        into the largest one.
         
-        @param      self  Data object
+        @param      self           Data object
+        @param      p_thresh       Threshold in units of the noise level
+        @param      p_pre          Samples before the peak in an epoch
+        @param      p_post         Samples after the peak in an epoch
+        @param      p_dt           Peak search and merge window (samples)
+        @param      p_radius       Neighbour distance for merging events
+        @param      p_tmad         Samples used for the noise level, taken
+                                   in chunks spread over the recording, all
+                                   if None
+        @param      p_chunk        Number of time points per chunk
+        @param      flag_negative  Detect negative peaks only, otherwise
+                                   absolute values
         
-        @return     { None }
+        @return     { Event table (t_ind, channel, amplitude) and the epochs
+                      (n_ch x (p_pre + p_post)) as views into the recording }
         """
+        from scipy.spatial.distance import cdist
+        rec = self.get_rec()
+        n_ch, n_t = rec.shape
+        # Noise level
+        if p_tmad is None or p_tmad >= n_t:
+            starts, p_seg = [0], n_t
+        else:
+            p_seg = min(p_chunk, p_tmad)
+            starts = np.linspace(0, n_t - p_seg,
+                                 -(-p_tmad // p_seg)).astype(int)
+        seg = np.hstack([np.asarray(rec[:, t:t + p_seg], dtype=float)
+                         for t in starts])
+        thr = p_thresh * np.median(np.abs(seg - np.median(seg, axis=1)[:, None]),
+                                   axis=1) / 0.6745
+        del seg
+        # Threshold crossings and peaks
+        ev_t, ev_ch, ev_amp = [], [], []
+        for t in range(0, n_t, p_chunk):
+            t_start = max(t - 1, 0)
+            block = np.asarray(rec[:, t_start:t + p_chunk + p_dt],
+                               dtype=float)
+            if flag_negative:
+                block = -block
+            else:
+                block = np.abs(block)
+            above = block > thr[:, None]
+            n_cross = min(t + p_chunk, n_t) - t_start
+            cross = above[:, 1:n_cross] & ~above[:, :n_cross - 1]
+            ch, tt = np.nonzero(cross)
+            tt = tt + 1
+            win = np.minimum(tt[:, None] + np.arange(p_dt),
+                             block.shape[1] - 1)
+            peak = np.argmax(block[ch[:, None], win], axis=1)
+            ev_t.append(win[np.arange(win.shape[0]), peak] + t_start)
+            ev_ch.append(ch)
+            ev_amp.append(block[ch, win[np.arange(win.shape[0]), peak]])
+        ev_t = np.concatenate(ev_t)
+        ev_ch = np.concatenate(ev_ch)
+        ev_amp = np.concatenate(ev_amp)
+        order = np.argsort(ev_t, kind='mergesort')
+        ev_t, ev_ch, ev_amp = ev_t[order], ev_ch[order], ev_amp[order]
+        # Merge events on neighbouring electrodes
+        neighbors = cdist(self.electrode_pos,
+                          self.electrode_pos) <= p_radius
+        keep = np.ones(ev_t.shape[0], dtype=bool)
+        k = 1
+        while k < ev_t.shape[0] and np.any(ev_t[k:] - ev_t[:-k] <= p_dt):
+            close = (ev_t[k:] - ev_t[:-k] <= p_dt) & \
+                neighbors[ev_ch[:-k], ev_ch[k:]]
+            keep[:-k][close & (ev_amp[:-k] < ev_amp[k:])] = False
+            keep[k:][close & (ev_amp[k:] <= ev_amp[:-k])] = False
+            k += 1
+        # Drop events without a full epoch
+        keep &= (ev_t >= p_pre) & (ev_t + p_post <= n_t)
+        self.events = np.zeros(np.sum(keep), dtype=[('t_ind', int),
+                                                    ('channel', int),
+                                                    ('amplitude', float)])
+        self.events['t_ind'] = ev_t[keep]
+        self.events['channel'] = ev_ch[keep]
+        self.events['amplitude'] = ev_amp[keep]
+        # Epochs
+        n_win = p_pre + p_post
+        if isinstance(rec, np.ndarray):
+            windows = as_strided(rec, shape=(n_t - n_win + 1, n_ch, n_win),
+                                 strides=(rec.strides[1], rec.strides[0],
+                                          rec.strides[1]),
+                                 writeable=False)
+            self.epochs = [windows[te - p_pre] for te in self.events['t_ind']]
+        else:
+            self.epochs = [rec[:, te - p_pre:te + p_post]
+                           for te in self.events['t_ind']]
+        return self.events, self.epochs
 
-    def cmp_cov_sensor(self):
+    def cmp_cov_sensor(self, p_chunk=2 ** 16, p_shrink=0., p_pre=10,
+                       p_post=20, flag_baseline=True):
         """
-        compute the covariance matrix for sensors
+        compute the covariance matrix for sensors in a single pass over the
+        recording, chunk statistics are merged with the Welford/Chan update.
+        Epochs around the detected events (epoch_data) are left out if
+        flag_baseline is set.
         
-        @param      self  Data object
+        @param      self           Data object
+        @param      p_chunk        Number of time points per chunk
+        @param      p_shrink       Shrinkage towards trace(C)/n_ch*I (0-1)
+        @param      p_pre          Samples excluded before an event
+        @param      p_post         Samples excluded after an event
+        @param      flag_baseline  Exclude the events in self.events
         
-        @return     { None }
+        @return     { Covariance matrix (n_ch x n_ch), also self.cov_sensor }
         """
+        rec = self.get_rec()
+        n_ch, n_t = rec.shape
+        if flag_baseline and hasattr(self, 'events'):
+            ev_start = np.sort(self.events['t_ind']) - p_pre
+            ev_stop = np.sort(self.events['t_ind']) + p_post
+        else:
+            ev_start = ev_stop = np.zeros(0, dtype=int)
+        n = 0
+        mean = np.zeros(n_ch)
+        m2 = np.zeros((n_ch, n_ch))
+        for t in range(0, n_t, p_chunk):
+            block = np.asarray(rec[:, t:t + p_chunk], dtype=float)
+            # Samples inside event epochs
+            i0 = np.searchsorted(ev_stop, t, side='right')
+            i1 = np.searchsorted(ev_start, t + block.shape[1])
+            if i1 > i0:
+                marks = np.zeros(block.shape[1] + 1, dtype=int)
+                np.add.at(marks, np.clip(ev_start[i0:i1] - t, 0,
+                                         block.shape[1]), 1)
+                np.add.at(marks, np.clip(ev_stop[i0:i1] - t, 0,
+                                         block.shape[1]), -1)
+                block = block[:, np.cumsum(marks[:-1]) == 0]
+            m = block.shape[1]
+            if m == 0:
+                continue
+            mean_b = np.mean(block, axis=1)
+            block = block - mean_b[:, None]
+            delta = mean_b - mean
+            n_new = n + m
+            m2 += np.dot(block, block.T) + \
+                np.outer(delta, delta) * (float(n) * m / n_new)
+            mean += delta * (float(m) / n_new)
+            n = n_new
+        cov = m2 / max(n - 1, 1)
+        if p_shrink > 0:
+            cov = (1. - p_shrink) * cov + \
+                p_shrink * np.trace(cov) / n_ch * np.eye(n_ch)
+        self.cov_sensor = cov
+        return cov
 
-    def cmp_pca_ica(self):
+    def cmp_pca_ica(self, t_ind=0, t_int=None, p_k=5, p_oversample=10,
+                    p_iter=2, p_seed=0):
         """
         compute pca, ica, dimensionality reduction
+        Randomized SVD over the time axis of a recording window, the window
+        is projected onto its top p_k temporal components.
         
-        @param      self  Data object
+        @param      self          Data object
+        @param      t_ind         First time point of the window
+        @param      t_int         Number of time points, all if None
+        @param      p_k           Number of temporal components
+        @param      p_oversample  Additional random vectors for the range
+        @param      p_iter        Number of power iterations
+        @param      p_seed        Seed for the random projection
         
-        @return     { None }
+        @return     { Dictionary with components (p_k x t_int), scores
+                      (n_ch x p_k) and singular values, also self.pca }
         """
+        rec = self.get_rec()
+        if t_int is None:
+            t_int = rec.shape[1] - t_ind
+        y = np.asarray(rec[:, t_ind:t_ind + t_int], dtype=float)
+        p_k = min(p_k, min(y.shape))
+        rng = np.random.RandomState(p_seed)
+        # Range of y' (temporal space)
+        omega = rng.standard_normal((y.shape[0],
+                                     min(p_k + p_oversample, y.shape[0])))
+        q = np.linalg.qr(np.dot(y.T, omega))[0]
+        for i in range(p_iter):
+            q = np.linalg.qr(np.dot(y, q))[0]
+            q = np.linalg.qr(np.dot(y.T, q))[0]
+        u_b, s, vt_b = np.linalg.svd(np.dot(q.T, y.T), full_matrices=False)
+        components = np.dot(q, u_b[:, :p_k]).T
+        self.pca = {'components': components,
+                    'scores': np.dot(y, components.T),
+                    's': s[:p_k]}
+        return self.pca
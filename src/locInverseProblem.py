@@ -10,6 +10,9 @@ License for more details.
 """
 import numpy as np
 from scipy.spatial.distance import cdist
+from scipy.sparse import coo_matrix, csc_matrix
+from scipy.linalg import cholesky, solve_triangular
+from locCache import data_cache
 import pickle as pc
 import os, os.path
 
@@ -24,19 +27,49 @@ class data_out(object):
                         'p_jlen': 2,
                         'p_erad': 5,
                         'p_maxd': 55,
+                        'p_sigma': 0.3,
+                        'p_eblock': 256,
+                        'p_vblock': 4096,
+                        'flag_float32': False,
+                        'flag_cache': False,
+                        'cache_dir': '../results/cache/',
+                        'p_cache_size': 2 ** 30,
+                        'p_seed': 0,
+                        'flag_octree': False,
+                        'p_olevels': 3,
+                        'p_oratio': 1.,
                         't_ind': 0,
                         }
         self.options.update(kwargs)
         self.t_ind = self.options['t_ind']
         print 'Parameter options:', self.options
+        if self.options['flag_cache']:
+            self.cache = data_cache(self.options['cache_dir'],
+                                    p_cache_size=self.options['p_cache_size'])
+        else:
+            self.cache = None
+        self.octree = None
         if kwargs.get('voxels') is not None:
             self.voxels = kwargs.get('voxels')
+            self.grid = self.get_grid_descriptor(self.voxels)
+            self.octree = kwargs.get('octree')
+        elif self.options['flag_octree']:
+            self.voxels = self.create_octree_voxels(
+                self.electrode_pos,
+                p_vres=self.options['p_vres'],
+                el_radius=self.options['p_erad'],
+                max_depth=self.options['p_maxd'],
+                p_jlen=self.options['p_jlen'],
+                p_seed=self.options['p_seed'],
+                p_olevels=self.options['p_olevels'],
+                p_oratio=self.options['p_oratio'])
         else:
             self.voxels = self.create_voxels(self.electrode_pos,
                                              p_vres=self.options['p_vres'],
                                              el_radius=self.options['p_erad'],
                                              max_depth=self.options['p_maxd'],
-                                             p_jlen=self.options['p_jlen'])
+                                             p_jlen=self.options['p_jlen'],
+                                             p_seed=self.options['p_seed'])
 
     def cmp_sloreta(self):
         """
@@ -46,15 +79,142 @@ class data_out(object):
         
         @return     { None }
         """
-        self.fwd = self.cmp_fwd_matrix(self.electrode_pos, self.voxels)
-        self.dw = self.cmp_weight_matrix(self.fwd)
-        self.inv = self.cmp_inv_matrix(self.fwd, self.dw)
+        self.cmp_sloreta_kernel()
         self.res = np.dot(self.inv, self.data.electrode_rec)
 
+    def cmp_sloreta_kernel(self):
+        """
+        computes the forward matrix, the depth weights and the inverse
+        matrix used by cmp_sloreta and iter_sloreta, data.cov_sensor is used
+        as the noise covariance if available
+        
+        @param      self  The inverse object
+        
+        @return     { None }
+        """
+        self.fwd = self.cmp_cached('fwd', {}, self.cmp_fwd_matrix,
+                                   self.electrode_pos, self.voxels,
+                                   **self.get_fwd_options())
+        self.dw = self.cmp_cached('depth', {}, self.cmp_weight_matrix,
+                                  self.fwd)
+        cov_n = getattr(self.data, 'cov_sensor', None)
+        if cov_n is None:
+            self.svd = self.cmp_cached('svd', {}, self.cmp_svd,
+                                       self.fwd, self.dw)
+        else:
+            self.svd = self.cmp_cached('svd', {'cov_n': cov_n}, self.cmp_svd,
+                                       self.fwd, self.dw, cov_n)
+        self.inv = self.cmp_inv_matrix(self.fwd, self.dw,
+                                       svd_matrix=self.svd)
+
+    def iter_sloreta(self, p_chunk=4096, p_topk=None, p_thresh=None,
+                     out=None):
+        """
+        applies the sloreta inverse to the recording in time chunks, the
+        memory is bounded by the chunk size instead of the recording length
+        
+        @param      self      The inverse object
+        @param      p_chunk   Number of time points per chunk
+        @param      p_topk    Keep only the k largest voxels per time point
+        @param      p_thresh  Keep only voxels with |x| > p_thresh as a
+                              sparse matrix
+        @param      out       Array or memmap (n_v x n_t) the dense estimates
+                              are written to
+        
+        @return     { Generator of (t_start, estimate), the estimate is dense
+                      (n_v x chunk), (indices, values) of shape (k x chunk)
+                      for p_topk or a scipy.sparse.csc_matrix for p_thresh }
+        """
+        if getattr(self, 'inv', None) is None:
+            self.cmp_sloreta_kernel()
+        rec = self.data.electrode_rec
+        n_t = rec.shape[1]
+        if p_topk is not None:
+            p_topk = min(p_topk, self.inv.shape[0])
+        for t in range(0, n_t, p_chunk):
+            res = np.dot(self.inv, np.asarray(rec[:, t:t + p_chunk]))
+            if out is not None:
+                out[:, t:t + res.shape[1]] = res
+            if p_topk is not None:
+                ind = np.argpartition(-np.abs(res), p_topk - 1,
+                                      axis=0)[:p_topk]
+                yield t, (ind, res[ind, np.arange(res.shape[1])])
+            elif p_thresh is not None:
+                res[np.abs(res) <= p_thresh] = 0
+                yield t, csc_matrix(res)
+            else:
+                yield t, res
+
+    def get_fwd_options(self):
+        """
+        Forward matrix options from the parameter options
+        
+        @param      self  The inverse object
+        
+        @return     { Keyword arguments for cmp_fwd_matrix }
+        """
+        return {'p_sigma': self.options['p_sigma'],
+                'p_eblock': self.options['p_eblock'],
+                'p_vblock': self.options['p_vblock'],
+                'flag_float32': self.options['flag_float32']}
+
+    def cmp_cached(self, name, params, func, *args, **kwargs):
+        """
+        Computes a geometry dependent matrix or loads it from the lead field
+        cache. The key hashes the electrode positions, the voxels, the
+        conductivity and the given parameters.
+        
+        @param      self    The inverse object
+        @param      name    Name of the matrix (fwd, depth, svd)
+        @param      params  Additional parameters the matrix depends on
+        @param      func    Function computing the matrix
+        @param      args    Arguments for func
+        @param      kwargs  Keyword arguments for func
+        
+        @return     { Matrix, memory-mapped if it was cached }
+        """
+        if self.cache is None:
+            return func(*args, **kwargs)
+        params = dict(params)
+        params['p_sigma'] = self.options['p_sigma']
+        params['flag_float32'] = self.options['flag_float32']
+        if self.grid is not None:
+            params.update(self.grid)
+            key = self.cache.get_key(name, self.electrode_pos, **params)
+        else:
+            key = self.cache.get_key(name, self.electrode_pos, self.voxels,
+                                     **params)
+        return self.cache.cmp_cached(key, func, *args, **kwargs)
+
+    def get_grid_descriptor(self, voxels):
+        """
+        Describe a regular voxel grid by its origin, spacing and shape
+        
+        @param      self    The inverse problem object
+        @param      voxels  The voxels (3 x ni x nj x nk)
+        
+        @return     { Grid descriptor or None if the grid is not regular }
+        """
+        if voxels.ndim != 4 or min(voxels.shape[1:]) < 2:
+            return None
+        origin = voxels[:, 0, 0, 0]
+        spacing = voxels[:, 1, 1, 1] - origin
+        shape = voxels.shape[1:]
+        ind = np.indices(shape).reshape(3, -1)
+        if not np.allclose(origin[:, None] + spacing[:, None] * ind,
+                           voxels.reshape(3, -1)):
+            return None
+        return {'origin': tuple(origin.tolist()),
+                'spacing': tuple(spacing.tolist()),
+                'shape': tuple(shape),
+                'jitter': (0., 0., 0.)}
+
     def create_voxels(self, electrode_pos, p_vres=5,
-                      el_radius=5, max_depth=55, p_jlen=2, flag_bound=False):
+                      el_radius=5, max_depth=55, p_jlen=2, flag_bound=False,
+                      p_seed=None):
         """
-        Create voxel space w.r.t. electrode positions
+        Create voxel space w.r.t. electrode positions, the grid descriptor is
+        stored in self.grid
         
         @param      self           The inverse problem object
         @param      electrode_pos  Electrode positions
@@ -63,10 +223,15 @@ class data_out(object):
         @param      max_depth      Maximum distance from the electrodes
         @param      p_jlen         Jitter value for the voxels
         @param      flag_bound     Sets Voxel Volume larger then the electrode area
+        @param      p_seed         Seed or np.random.RandomState for the jitter
         
         @return     { Voxels in as numpy array }
         """
-        jitter_vector = np.random.random((3, )) * p_jlen   # iCSD Leski
+        if isinstance(p_seed, np.random.RandomState):
+            rng = p_seed
+        else:
+            rng = np.random.RandomState(p_seed)
+        jitter_vector = rng.random_sample((3, )) * p_jlen   # iCSD Leski
         n_elx = np.unique(electrode_pos[:, 0]).shape[0]
         n_ely = np.unique(electrode_pos[:, 1]).shape[0]
         n_elz = np.unique(electrode_pos[:, 2]).shape[0]
@@ -90,87 +255,344 @@ class data_out(object):
             max_el += 1
         min_el.mask[elec_normal] = False
         max_el.mask[elec_normal] = False
-        return (np.mgrid[min_el[0]:max_el[0]:p_vres,
-                         min_el[1]:max_el[1]:p_vres,
-                         min_el[2]:max_el[2]:p_vres].T
-                + jitter_vector).T
+        voxels = (np.mgrid[min_el[0]:max_el[0]:p_vres,
+                           min_el[1]:max_el[1]:p_vres,
+                           min_el[2]:max_el[2]:p_vres].T
+                  + jitter_vector).T
+        self.grid = {'origin': tuple(np.asarray(min_el).tolist()),
+                     'spacing': (float(p_vres), ) * 3,
+                     'shape': voxels.shape[1:],
+                     'jitter': tuple(jitter_vector.tolist())}
+        return voxels
+
+    def create_octree_voxels(self, electrode_pos, p_vres=5, el_radius=5,
+                             max_depth=55, p_jlen=2, p_seed=None,
+                             p_olevels=3, p_oratio=1.):
+        """
+        Adaptive voxel space, an octree over the grid of create_voxels whose
+        cells are split down to p_vres near the electrodes and may grow to
+        p_vres * 2^p_olevels with the distance from the electrode plane.
+        Cells sticking out of the grid are split, so the leaves tile the
+        grid exactly. The octree is
+        stored in self.octree: grid origin, spacing and shape, the leaf
+        corners and sizes in grid steps, the leaf label of every grid point
+        and the face neighbour tables.
+        
+        @param      self           The inverse problem object
+        @param      electrode_pos  Electrode positions
+        @param      p_vres         Finest voxel resolution
+        @param      el_radius      Interelectrode distance
+        @param      max_depth      Maximum distance from the electrodes
+        @param      p_jlen         Jitter value for the voxels
+        @param      p_seed         Seed or np.random.RandomState for the jitter
+        @param      p_olevels      Number of coarser octree levels
+        @param      p_oratio       Largest cell size relative to the distance
+                                   from the electrode plane
+        
+        @return     { Voxel centers (3 x n_v) }
+        """
+        voxels = self.create_voxels(electrode_pos, p_vres=p_vres,
+                                    el_radius=el_radius, max_depth=max_depth,
+                                    p_jlen=p_jlen, p_seed=p_seed)
+        shape = np.array(voxels.shape[1:])
+        origin = voxels[:, 0, 0, 0]
+        elec_normal = [np.unique(electrode_pos[:, d]).shape[0]
+                       for d in range(3)].index(1)
+        plane = electrode_pos[0, elec_normal]
+        # root cells tile the grid, cells are (corner, size) in grid steps
+        n_root = 2 ** p_olevels
+        corner = np.indices(-(-shape // n_root)).reshape(3, -1) * n_root
+        size = n_root * np.ones(corner.shape[1], dtype=int)
+        children = np.indices((2, 2, 2)).reshape(3, 8)
+        leaf_corner, leaf_size = [], []
+        while corner.shape[1]:
+            center = corner + (size - 1) / 2.
+            depth = np.abs(origin[elec_normal] + center[elec_normal] * p_vres
+                           - plane)
+            # cells sticking out of the grid are split as well
+            split = (size > 1) & ((size * p_vres > p_oratio * depth) |
+                                  np.any(corner + size[None, :] >
+                                         shape[:, None], 0))
+            leaf_corner.append(corner[:, ~split])
+            leaf_size.append(size[~split])
+            size = np.repeat(size[split] // 2, 8)
+            corner = (corner[:, split, None] + children[:, None, :] *
+                      size.reshape(-1, 8)[None, :, :]).reshape(3, -1)
+            inside = np.all(corner < shape[:, None], 0)
+            corner, size = corner[:, inside], size[inside]
+        corner = np.hstack(leaf_corner)
+        size = np.hstack(leaf_size)
+        # grid order, the octree without coarser levels is the grid
+        order = np.argsort(np.ravel_multi_index(corner, shape))
+        corner, size = corner[:, order], size[order]
+        labels = np.zeros(shape, dtype=int)
+        for s in np.unique(size):
+            ind = np.nonzero(size == s)[0]
+            pts = (corner[:, ind, None] +
+                   np.indices((s, s, s)).reshape(3, 1, -1)).reshape(3, -1)
+            labels[tuple(pts)] = np.repeat(ind, s ** 3)
+        self.grid = None
+        self.octree = {'origin': origin,
+                       'spacing': float(p_vres),
+                       'shape': tuple(shape),
+                       'corner': corner,
+                       'size': size,
+                       'labels': labels,
+                       'neighbours': self.cmp_octree_neighbours(labels,
+                                                                size.shape[0])}
+        return origin[:, None] + (corner + (size - 1) / 2.) * p_vres
 
-    def cmp_fwd_matrix(self, electrode_pos, voxels, p_sigma=0.3):
+    def cmp_octree_neighbours(self, labels, n_v):
+        """
+        Face neighbour tables of an octree from the leaf labels of the grid
+        points, two leaves are neighbours along a dimension if grid points
+        next to each other belong to them
+        
+        @param      self    The inverse problem object
+        @param      labels  Leaf label of every grid point, -1 outside the
+                            leaves
+        @param      n_v     Number of leaves
+        
+        @return     { List of 3 sparse matrices (n_v x n_v), entry (i, j) is
+                      the shared face area (in grid steps^2) with j in
+                      positive direction from i }
+        """
+        neighbours = []
+        for d in range(3):
+            n = labels.shape[d]
+            lo = labels.take(np.arange(n - 1), axis=d).flatten()
+            hi = labels.take(np.arange(1, n), axis=d).flatten()
+            face = (lo != hi) & (lo >= 0) & (hi >= 0)
+            neighbours.append(coo_matrix((np.ones(np.sum(face)),
+                                          (lo[face], hi[face])),
+                                         shape=(n_v, n_v)).tocsr())
+        return neighbours
+
+    def get_regular_voxels(self):
+        """
+        Grid points of the finest octree level
+        
+        @param      self  The inverse problem object
+        
+        @return     { Voxels (3 x ni x nj x nk) }
+        """
+        shape = self.octree['shape']
+        return (self.octree['origin'].reshape(3, 1, 1, 1) +
+                np.indices(shape) * self.octree['spacing'])
+
+    def get_regular_values(self, values):
+        """
+        Values of the octree leaves at the grid points of the finest level,
+        zero at grid points outside the leaves
+        
+        @param      self    The inverse problem object
+        @param      values  The values (n_v x ...)
+        
+        @return     { Values (n_grid x ...) }
+        """
+        values = np.asarray(values)
+        values = np.concatenate([values, np.zeros((1, ) + values.shape[1:])])
+        return values[self.octree['labels'].flatten()]
+
+    def cmp_fwd_matrix(self, electrode_pos, voxels, p_sigma=0.3,
+                       p_eblock=256, p_vblock=4096, flag_float32=False):
         """
         Calculate the m-by-n forward matrix given by
         1/(4*pi*sigma)*(1/(d(el_pos-vox_pos)^2)
+        The distances are computed in electrode-by-voxel blocks, so the
+        temporary memory is bounded by p_eblock*p_vblock.
         
         @param      self           The inverse problem object
         @param      electrode_pos  The electrode position
         @param      voxels         The voxels
         @param      p_sigma        Extracellular conductance
+        @param      p_eblock       Number of electrodes per block
+        @param      p_vblock       Number of voxels per block
+        @param      flag_float32   Return a single precision matrix
         
-        @return     { description_of_the_return_value }
+        @return     { Forward matrix (n_el x n_v) }
         """
-        vx, vy, vz = voxels
+        vox_pos = voxels.reshape(3, -1).T
         elx, ely, elz = electrode_pos.T
-        # Flatten
-        vx, vy, vz = vx.flatten(), vy.flatten(), vz.flatten()
         # Electrode geometry
         n_elx = np.unique(elx).shape[0]
         n_ely = np.unique(ely).shape[0]
         n_elz = np.unique(elz).shape[0]
         n_el = n_elx * n_ely * n_elz
-        n_v = vx.shape[0]
+        n_v = vox_pos.shape[0]
         # Check position vector formats
         if n_el != elx.shape[0] or n_el != ely.shape[0] \
                 or n_el != elz.shape[0] or n_el <= 0:
             print 'Electrode coordinates are wrong'
-        fwd_matrix = np.zeros((n_el, n_v))
-        for el in np.arange(0, n_el):
-            for v in np.arange(0, n_v):
-                fwd_matrix[el, v] = np.sqrt((elx[el] - vx[v]) ** 2 +
-                                            (ely[el] - vy[v]) ** 2 +
-                                            (elz[el] - vz[v]) ** 2)
-        return 1. / (fwd_matrix * (4. * np.pi * p_sigma))
+        if flag_float32:
+            fwd_matrix = np.empty((electrode_pos.shape[0], n_v),
+                                  dtype=np.float32)
+        else:
+            fwd_matrix = np.empty((electrode_pos.shape[0], n_v),
+                                  dtype=np.float64)
+        for el in range(0, electrode_pos.shape[0], p_eblock):
+            for v in range(0, n_v, p_vblock):
+                fwd_matrix[el:el + p_eblock, v:v + p_vblock] = \
+                    cdist(electrode_pos[el:el + p_eblock],
+                          vox_pos[v:v + p_vblock])
+        fwd_matrix *= 4. * np.pi * p_sigma
+        return np.reciprocal(fwd_matrix, out=fwd_matrix)
+
+    def cmp_svd(self, fwd_matrix, depth_norm_vector, cov_n=None):
+        """
+        Thin SVD of the depth weighted forward matrix F*W^(1/2) = U*S*V'.
+        The factors are stacked into a single matrix so that they can be
+        cached, use split_svd to get them back. With a noise covariance
+        C = L*L' the whitened matrix L^-1*F*W^(1/2) is factorized and L^-T*U
+        is stored, so applying U' also whitens the data.
+        
+        @param      self               The inverse problem object
+        @param      fwd_matrix         The forward matrix
+        @param      depth_norm_vector  The depth normalization weights
+        @param      cov_n              Noise covariance, identity if None
+        
+        @return     { [U; s; W^(1/2)*V] as (n_el + 1 + n_v) x k matrix }
+        """
+        w_sqrt = np.sqrt(depth_norm_vector)
+        if cov_n is None:
+            u, s, vt = np.linalg.svd(fwd_matrix * w_sqrt,
+                                     full_matrices=False)
+        else:
+            chol = cholesky(cov_n, lower=True)
+            u, s, vt = np.linalg.svd(solve_triangular(chol, fwd_matrix,
+                                                      lower=True) * w_sqrt,
+                                     full_matrices=False)
+            u = solve_triangular(chol, u, lower=True, trans='T')
+        return np.vstack([u, s[None, :], vt.T * w_sqrt[:, None]])
 
-    def cmp_inv_matrix(self, fwd_matrix, depth_norm_matrix,
-                       p_lmbda=1e-2, snr=5):
+    def split_svd(self, svd_matrix):
+        """
+        Splits the stacked SVD factors from cmp_svd
+        
+        @param      self        The inverse problem object
+        @param      svd_matrix  The stacked SVD factors
+        
+        @return     { U (n_el x k), s (k), W^(1/2)*V (n_v x k) }
+        """
+        n_el = self.electrode_pos.shape[0]
+        return (svd_matrix[:n_el], svd_matrix[n_el],
+                svd_matrix[n_el + 1:])
+
+    def cmp_lmbda(self, svd_matrix, snr=5):
+        """
+        Regularization parameter from the signal-to-noise ratio,
+        trace(F*W*F')/(trace(C)*snr^2) with trace(F*W*F') = sum(s^2),
+        in whitened coordinates if a noise covariance was used
+        
+        @param      self        The inverse problem object
+        @param      svd_matrix  The stacked SVD factors
+        @param      snr         Signal-to-Noise ratio
+        
+        @return     { Regularization parameter }
+        """
+        u, s, vw = self.split_svd(svd_matrix)
+        return np.sum(s ** 2) / (u.shape[0] * snr ** 2)
+
+    def cmp_inv_matrix(self, fwd_matrix, depth_norm_vector,
+                       p_lmbda=None, snr=5, svd_matrix=None, cov_n=None):
         """
         Computes regularized inverse matrix in the given method 
+        W*F'*(F*W*F' + lmbda^2*C)^-1 = W^(1/2)*V*diag(s/(s^2+lmbda^2))*U'
         
         @param      self               The inverse problem object
         @param      fwd_matrix         The forward matrix
-        @param      depth_norm_matrix  The depth normalize matrix
-        @param      p_lmbda            Regularization parameter
+        @param      depth_norm_vector  The depth normalization weights
+        @param      p_lmbda            Regularization parameter, derived from
+                                       snr if None
         @param      snr                Signal-to-Noise ratio
+        @param      svd_matrix         Stacked SVD factors from cmp_svd,
+                                       computed if None
+        @param      cov_n              Noise covariance, identity if None
+        
+        @return     { Inverse matrix (n_v x n_el) }
+        """
+        if svd_matrix is None:
+            svd_matrix = self.cmp_svd(fwd_matrix, depth_norm_vector, cov_n)
+        if p_lmbda is None:
+            p_lmbda = self.cmp_lmbda(svd_matrix, snr)
+        u, s, vw = self.split_svd(svd_matrix)
+        return np.dot(vw * (s / (s ** 2 + p_lmbda ** 2)), u.T)
+
+    def apply_inv_matrix(self, svd_matrix, rec, p_lmbda):
+        """
+        Applies the regularized inverse to recordings without forming it,
+        O(n_el*n_v) per time point
         
-        @return     { description_of_the_return_value }
+        @param      self        The inverse problem object
+        @param      svd_matrix  The stacked SVD factors
+        @param      rec         Recordings (n_el x n_t)
+        @param      p_lmbda     Regularization parameter
+        
+        @return     { Source estimate (n_v x n_t) }
         """
-        cov_n = np.eye(fwd_matrix.shape[0])
-        p_lmbda = np.trace(np.dot(np.dot(fwd_matrix, depth_norm_matrix),
-                                  fwd_matrix.T))/(np.trace(cov_n)*snr**2)
-        inv_matrix = np.dot(np.dot(depth_norm_matrix,
-                                   np.transpose(fwd_matrix)),
-                            np.linalg.inv(
-                            np.dot(np.dot(fwd_matrix, depth_norm_matrix),
-                                   np.transpose(
-                                       fwd_matrix)) + (p_lmbda ** 2) * cov_n))
-        return inv_matrix
+        u, s, vw = self.split_svd(svd_matrix)
+        coef = np.dot(u.T, rec)
+        if coef.ndim == 1:
+            coef = coef * (s / (s ** 2 + p_lmbda ** 2))
+        else:
+            coef = coef * (s / (s ** 2 + p_lmbda ** 2))[:, None]
+        return np.dot(vw, coef)
+
+    def cmp_lmbda_sweep(self, svd_matrix, rec, lmbdas, cov_n=None):
+        """
+        Residual norm, solution norm (L-curve) and generalized cross
+        validation score for a grid of regularization parameters, all
+        computed from the SVD at once
+        
+        @param      self        The inverse problem object
+        @param      svd_matrix  The stacked SVD factors
+        @param      rec         Recordings (n_el x n_t)
+        @param      lmbdas      Regularization parameters
+        @param      cov_n       Noise covariance used for the SVD
+        
+        @return     { Dictionary with lmbda, res_norm, sol_norm, gcv and the
+                      lmbda minimizing gcv }
+        """
+        u, s, vw = self.split_svd(svd_matrix)
+        lmbdas = np.atleast_1d(np.asarray(lmbdas, dtype=float))
+        rec = np.asarray(rec).reshape(u.shape[0], -1)
+        n_el = u.shape[0]
+        coef = np.sum(np.dot(u.T, rec) ** 2, axis=1)
+        # Part of the (whitened) data outside the range of F
+        if cov_n is not None:
+            rec = solve_triangular(cholesky(cov_n, lower=True), rec,
+                                   lower=True)
+        res_out = max(np.sum(rec ** 2) - np.sum(coef), 0.)
+        s2 = s[None, :] ** 2
+        l2 = lmbdas[:, None] ** 2
+        filt = s2 / (s2 + l2)
+        res_norm = np.sqrt(np.sum((1. - filt) ** 2 * coef, axis=1) + res_out)
+        sol_norm = np.sqrt(np.sum(filt ** 2 / s2 * coef, axis=1))
+        gcv = res_norm ** 2 / (n_el - np.sum(filt, axis=1)) ** 2
+        return {'lmbda': lmbdas,
+                'res_norm': res_norm,
+                'sol_norm': sol_norm,
+                'gcv': gcv,
+                'lmbda_gcv': lmbdas[np.argmin(gcv)]}
 
     def cmp_weight_matrix(self, fwd_matrix, p_depth=1.):
         """
-        Calculate the column(depth) normalization matrix given by
+        Calculate the column(depth) normalization weights given by
         (1./sum(a_i^2))^depth_par - column norm for fwd_matrix[:,i]
+        The weights are the diagonal of the normalization matrix.
         
         @param      self        The inverse object
         @param      fwd_matrix  The forward matrix
         @param      p_depth     Depth normalization norm order
         
-        @return     { description_of_the_return_value }
+        @return     { Depth normalization weights (n_v) }
         """
         def get_neighbors(self, voxels, i, j, k, d):
             """
             Looks for the neighboring voxels within -d-
             hamming distance given a (i,j,k)position
             """
-        return np.diag(np.power(np.sum(fwd_matrix ** 2, axis=0),
-                                1. / (2 * p_depth)))
+        return np.power(np.sum(fwd_matrix ** 2, axis=0), 1. / (2 * p_depth))
 
     def cmp_resolution_matrix(self, fwd_matrix, inv_matrix):
         """
@@ -13,10 +13,19 @@ import casadi as ca
 import numpy as np
 from casadi.tools import struct_symMX, entry, repeated
 from casadi.tools import *
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import cdist
+from scipy.sparse import coo_matrix, diags, identity, kron, vstack
+from scipy.ndimage import binary_dilation
+from multiprocessing import Pool
 import pickle as pc
+import hashlib
+import errno
 import os
 import os.path
+import shutil
+import subprocess
+import tempfile
 import time
 try:
     import matplotlib.pyplot as plt
@@ -82,6 +91,7 @@ class opt_out(data_out):
             self.s_shape = opts['str_shape']
             self.data = opts['data_cb']
             self.voxels = opts['voxels_cb']
+            self.labels = opts['labels_cb']
             self.p_method = opts['p_method']
             self.gt = opts['gt']
             opts['filename'] = None
@@ -91,6 +101,7 @@ class opt_out(data_out):
             opts['str_shape'] = None
             opts['data_cb'] = None
             opts['voxels_cb'] = None
+            opts['labels_cb'] = None
             opts['gt'] = None
             self.nx = nx
             self.ng = ng
@@ -138,8 +149,15 @@ class opt_out(data_out):
             # result
             n_depth = self.voxels.shape[2]
             cs_width = n_depth / 2
+            gt = self.gt
+            if self.labels is not None:
+                # octree leaves are shown on the finest grid, zero outside
+                xres_mid = np.vstack([xres_mid, np.zeros(xres_mid.shape[1])])
+                gt = np.vstack([gt, np.zeros(gt.shape[1])])
+                xres_mid = xres_mid[self.labels.flatten()]
+                gt = gt[self.labels.flatten()]
             resn = xres_mid[:, t_ind].reshape(rx.shape)
-            resReal = self.gt[:,t_ind].reshape(rx.shape)
+            resReal = gt[:,t_ind].reshape(rx.shape)
             resn_ind = np.abs(resn) > cmax
             xmin, xmax = np.min(vx), np.max(vx)
             ymin, ymax = np.min(vy), np.max(vy)
@@ -274,6 +292,22 @@ class opt_out(data_out):
                         'flag_data_mask': True,
                         'flag_write_output': True,
                         'flag_parallel': False,
+                        'p_pca': None,
+                        'flag_parametric': False,
+                        'p_warm_push': 1e-9,
+                        'p_warm_mu': 1e-5,
+                        'flag_codegen': False,
+                        'p_compiler': 'gcc',
+                        'p_cflags': '-O2',
+                        'p_fista_iter': 5000,
+                        'p_fista_tol': 1e-6,
+                        'p_screen': 10,
+                        'p_screen_iter': 200,
+                        'flag_screen': False,
+                        'p_mr_levels': 2,
+                        'p_mr_thresh': 0.1,
+                        'p_mr_margin': 1,
+                        'p_gt_knn': 16,
                         'flag_callback': True,
                         'flag_callback_plot': False,
                         'solver': 'ipopt',
@@ -306,20 +340,117 @@ class opt_out(data_out):
         self.p_hessian = self.opt_opt['hessian']
         self.p_linsol = self.opt_opt['linsol']
         self.p_dyn = self.opt_opt['p_dyn']
+        self.p_pca = self.opt_opt['p_pca']
+        # compiled NLPs take the measurements as parameters
+        self.flag_parametric = (self.opt_opt['flag_parametric'] or
+                                self.opt_opt['flag_codegen'])
+        self.p_warm_push = self.opt_opt['p_warm_push']
+        self.p_warm_mu = self.opt_opt['p_warm_mu']
+        self.solver_warm = None
+        self.flag_codegen = self.opt_opt['flag_codegen']
+        self.p_compiler = self.opt_opt['p_compiler']
+        self.p_cflags = self.opt_opt['p_cflags']
+        self.nlp_so = None
+        self.p_fista_iter = self.opt_opt['p_fista_iter']
+        self.p_fista_tol = self.opt_opt['p_fista_tol']
+        self.p_screen = self.opt_opt['p_screen']
+        self.p_screen_iter = self.opt_opt['p_screen_iter']
+        self.flag_screen = self.opt_opt['flag_screen']
+        self.screen = None
+        self.p_mr_levels = self.opt_opt['p_mr_levels']
+        self.p_mr_thresh = self.opt_opt['p_mr_thresh']
+        self.p_mr_margin = self.opt_opt['p_mr_margin']
+        self.w_init = None
+        self.p_gt_knn = self.opt_opt['p_gt_knn']
         # ######################## #
         #     Problem  setup       #
         # ######################## #
         print self.opt_opt
-        self.y = self.data.electrode_rec[:, self.t_ind:self.t_ind + self.t_int]
+        self.pca = None
+        self.set_measurements(self.t_ind)
         self.y_size = self.y.shape[0]
         self.t_size = self.y.shape[1]
+        if self.flag_parametric:
+            # Measurements and sigma are NLP parameters, see resolve
+            self.yp = ca.MX.sym('y', self.y_size, self.t_size)
+            self.sp = ca.MX.sym('sigma')
+        else:
+            self.yp = self.y
+            self.sp = self.sigma_value
+        self.set_voxels(self.voxels, self.grid, self.octree)
+
+    def set_voxels(self, voxels, grid=None, octree=None):
+        """
+        @brief      Sets the reconstruction voxels and computes the forward
+                    matrix for them, everything derived from the old voxels
+                    is reset
+        
+        @param      self    The optimization object
+        @param      voxels  The voxels (3 x ni x nj x nk) or octree voxels
+                            (3 x n_v)
+        @param      grid    The grid descriptor, computed from voxels if None
+        @param      octree  The octree of octree voxels, see
+                            create_octree_voxels
+        
+        @return     { None }
+        """
+        self.voxels = voxels
+        if grid is None:
+            grid = self.get_grid_descriptor(voxels)
+        self.grid = grid
+        self.octree = octree
         self.x_size = self.voxels[0, :].flatten().shape[0]
-        fwd = self.cmp_fwd_matrix(self.electrode_pos, self.voxels)
+        fwd = self.cmp_cached('fwd', {}, self.cmp_fwd_matrix,
+                              self.electrode_pos, self.voxels,
+                              **self.get_fwd_options())
         if self.flag_depthweighted:
-            dw = self.cmp_weight_matrix(fwd)
-            self.fwd = ca.MX(np.dot(fwd, dw))
+            dw = self.cmp_cached('depth', {}, self.cmp_weight_matrix, fwd)
+            self.fwd_matrix = fwd * dw
+        else:
+            self.fwd_matrix = np.asarray(fwd)
+        self.fwd = ca.MX(self.fwd_matrix)
+        self.lipschitz = None
+        self.diff_ops = {}
+        self.screen = None
+        self.solver_warm = None
+        self.nlp_so = None
+        self.gt_cache = {}
+
+    def set_measurements(self, t_ind):
+        """
+        @brief      Sets the measurements y for the window starting at t_ind.
+                    With p_pca the window is projected onto p_pca temporal
+                    components. In parametric mode the components of the
+                    first window are kept, so the NLP and warm starts of
+                    resolve stay in one basis.
+        
+        @param      self   The optimization object
+        @param      t_ind  First time point of the window
+        
+        @return     { None }
+        """
+        self.t_ind = t_ind
+        if self.p_pca and (self.pca is None or not self.flag_parametric):
+            # Fit p_pca temporal components instead of t_int samples
+            self.pca = self.data.cmp_pca_ica(self.t_ind, self.t_int,
+                                             p_k=self.p_pca)
+            self.y = self.pca['scores']
+        elif self.p_pca:
+            y = self.data.electrode_rec[:, self.t_ind:self.t_ind + self.t_int]
+            self.y = np.dot(y, self.pca['components'].T)
         else:
-            self.fwd = ca.MX(fwd)
+            self.pca = None
+            self.y = self.data.electrode_rec[:, self.t_ind:self.t_ind + self.t_int]
+
+    def get_parameters(self):
+        """
+        @brief      Numeric values of the NLP parameters [vec(y); sigma]
+        
+        @param      self  The optimization object
+        
+        @return     { Parameter vector }
+        """
+        return np.hstack([self.y.flatten('F'), self.sigma_value])
 
     def initialize_variables(self):
         """
@@ -330,7 +461,11 @@ class opt_out(data_out):
         @return     { None }
         """
         self.w0 = self.w(0)
-        csd = self.get_ground_truth()[0]
+        csd = self.get_ground_truth(t_ind=self.t_ind, t_int=self.t_int)[0]
+        if self.pca is not None:
+            csd = np.dot(csd, self.pca['components'].T)
+        if self.screen is not None:
+            csd = csd[self.screen]
         if self.method == 'thesis':
             tmp_s0 = np.random.randn(self.s.shape[0], self.s.shape[1])
             for i in range(self.s.shape[0]):
@@ -339,7 +474,7 @@ class opt_out(data_out):
             print 'initialization: Thesis'
         print self.method
         if self.method == 'thesis' or self.method == 'mask':
-            self.gt = np.reshape(csd[:,self.t_ind:self.t_ind+self.t_int], (self.w0['a'].shape))
+            self.gt = np.reshape(csd, (self.w0['a'].shape))
             # tmp_m0 = np.random.rand(self.m.shape[0])
             tmp_m0 = np.ones(self.m.shape[0])*0.5 + np.random.randn(self.m.shape[0])/50
             print tmp_m0
@@ -358,11 +493,11 @@ class opt_out(data_out):
                 self.w0['a'] = tmp_a0
                 self.w0['m'] = np.where(np.abs(self.gt) > 1e-3, 1, 0).T[0]
         if self.method == 'slack':
-            self.gt = np.reshape(csd[:,self.t_ind:self.t_ind+self.t_int], (self.w0['x'].shape))
+            self.gt = np.reshape(csd, (self.w0['x'].shape))
             if self.flag_init == 'rand':
                 self.w0['x'] = np.random.randn(self.gt)
         if self.method == '2p':
-            self.gt = np.reshape(csd[:,self.t_ind:self.t_ind+self.t_int], (self.w0['xs_pos'].shape))
+            self.gt = np.reshape(csd, (self.w0['xs_pos'].shape))
             pos_charges = np.zeros(self.w0['xs_pos'].shape)
             neg_charges = np.zeros(self.w0['xs_neg'].shape)
             pos_charges[self.gt > 0] = self.gt[self.gt > 0]
@@ -370,7 +505,7 @@ class opt_out(data_out):
             self.w0['xs_pos'] = pos_charges
             self.w0['xs_neg'] = neg_charges
         if self.method == 'dipole':
-            self.gt = np.reshape(csd[:,self.t_ind:self.t_ind+self.t_int], (self.w0['x_pos'].shape))
+            self.gt = np.reshape(csd, (self.w0['x_pos'].shape))
             pos_charges = np.zeros(self.w0['x_pos'].shape)
             neg_charges = np.zeros(self.w0['x_neg'].shape)
             pos_charges[self.gt > 0] = self.gt[self.gt > 0]
@@ -391,6 +526,51 @@ class opt_out(data_out):
                 self.w0['m_neg'] = np.where(neg_charges > 1e-3, 1, 0).T[0]
                 self.w0['x_pos'] = pos_charges
                 self.w0['x_neg'] = neg_charges
+        if self.w_init is not None:
+            # warm start, e.g. prolongated from a coarser grid
+            for key in self.w_init:
+                value = self.w_init[key]
+                if self.screen is not None and key != 'ys':
+                    value = value[self.screen]
+                self.w0[key] = value
+
+    def project_result(self, xres):
+        """
+        @brief      Maps a result back to the time samples if temporal
+                    components were fitted
+        
+        @param      self  The object
+        @param      xres  The result (x_size x t_size)
+        
+        @return     { Result (x_size x t_int) }
+        """
+        if self.pca is None:
+            return xres
+        return np.dot(xres, self.pca['components'])
+
+    def get_result(self):
+        """
+        @brief      Source estimate of the last solve
+        
+        @param      self  The optimization object
+        
+        @return     { Result (x_size x t_int) }
+        """
+        if self.method == 'slack':
+            xres = self.res_struct['x'].full()
+        elif self.method == '2p':
+            xres = (self.res_struct['xs_pos'].full() -
+                    self.res_struct['xs_neg'].full())
+        elif self.method == 'mask':
+            xres = self.res_struct['a'].full() * self.res_struct['m'].full()
+        else:
+            xres = self.res_struct['a'].full()
+        if self.screen is not None:
+            # screened voxels are zero
+            xfull = np.zeros((self.screen.shape[0], xres.shape[1]))
+            xfull[self.screen] = xres
+            xres = xfull
+        return self.project_result(xres)
 
     def minimize_function(self):
         """
@@ -408,6 +588,8 @@ class opt_out(data_out):
         self.initialize_variables()
         # Create NLP
         self.nlp = {"x": self.w, "f": self.f, "g": self.g}
+        if self.flag_parametric:
+            self.nlp["p"] = ca.vertcat(ca.vec(self.yp), self.sp)
         # NLP solver options
         if self.p_solver == 'ipopt':
             self.opts = {"ipopt.max_iter": 100000,
@@ -425,6 +607,12 @@ class opt_out(data_out):
                 "qpsol": "qpoases"
             }
         if self.flag_callback:
+            if self.octree is not None:
+                voxels_cb = self.get_regular_voxels()
+                labels_cb = self.octree['labels']
+            else:
+                voxels_cb = self.voxels
+                labels_cb = None
             print self.w.shape[0]
             print self.g.shape[0]
             self.mycallback = opt_out.MyCallback('mycallback', self.w.shape[0], self.g.shape[0], 0,
@@ -435,13 +623,18 @@ class opt_out(data_out):
                                                        'data_cb': self.data,
                                                        'p_method': self.method,
                                                        'gt': self.gt,
-                                                       'voxels_cb': self.voxels})
+                                                       'voxels_cb': voxels_cb,
+                                                       'labels_cb': labels_cb})
             self.opts["iteration_callback"] = self.mycallback
             self.opts["iteration_callback_step"] = self.callback_steps
         # self.opts["ipopt.fixed_variable_treatment"] = 'make_constraint'
         # Create solver
         print "Initializing the solver"
-        if self.p_solver == 'ipopt':
+        self.nlp_so = None
+        if self.p_solver == 'ipopt' and self.flag_codegen:
+            self.solver = ca.nlpsol("solver", "ipopt",
+                                    self.get_compiled_nlp(), self.opts)
+        elif self.p_solver == 'ipopt':
             self.solver = ca.nlpsol("solver", "ipopt", self.nlp, self.opts)
         elif self.p_solver == 'sqp':
             self.solver = ca.qpsol("solver", "qpoases", self.nlp)
@@ -452,298 +645,617 @@ class opt_out(data_out):
         self.args["ubx"] = self.ubx
         self.args["lbg"] = self.lbg
         self.args["ubg"] = self.ubg
+        if self.flag_parametric:
+            self.args["p"] = self.get_parameters()
         self.res = self.solver(**self.args)
+        self.stats = self.solver.stats()
         self.res_struct = self.w(self.res['x'])
 
-    def cmp_dx(self, smooth_entity, i, j, k, t, h=1.):
+    def get_nlp_key(self):
         """
-        @brief      Computes the forward difference along x dimension.
+        @brief      Hash of everything the generated NLP code depends on:
+                    solver options, geometry, forward matrix, screening,
+                    temporal components and the compiler. Measurements and
+                    sigma are parameters (flag_codegen implies
+                    flag_parametric) and are not part of it.
         
-        @param      self           The optimization object
-        @param      smooth_entity  The image to smooth
-        @param      i              { pixel index for x - dimension}
-        @param      j              { pixel index for y - dimension}
-        @param      k              { pixel index for z - dimension}
-        @param      t              { time index }
-        @param      h              { discretization step }
+        @param      self  The optimization object
         
-        @return     { returns the x derivative for a single pixel }
-        """
-        x = smooth_entity
-        vx, vy, vz = self.voxels
-        ni, nj, nk = vx.shape
-        ind0 = np.ravel_multi_index((i, j, k), vx.shape)
-        if i == 0:
-            # dx = 0 (1st order)
-            dx = 0
-        elif i == 1:
-            ind1 = np.ravel_multi_index((i + 1, j, k), vx.shape)
-            ind_1 = np.ravel_multi_index((i - 1, j, k), vx.shape)
-            ind2 = np.ravel_multi_index((i + 2, j, k), vx.shape)
-            # dx = 8(x1-x_1)-1(x2-x0) x0 instead of x_2 (2nd order)
-            dx = (8 * (x[ind1, t] - x[ind_1, t]) -
-                  1 * (x[ind2, t] - x[ind0, t])) / (12 * h)
-        elif i == ni - 1:
-            # dx = 0
-            dx = 0
-        elif i == ni - 2:
-            ind1 = np.ravel_multi_index((i + 1, j, k), vx.shape)
-            ind_1 = np.ravel_multi_index((i - 1, j, k), vx.shape)
-            ind_2 = np.ravel_multi_index((i - 2, j, k), vx.shape)
-            # dx = 8(x1-x_1)-1(x0-x_2) x0 instead of x2 (mirror)
-            dx = (8 * (x[ind1, t] - x[ind_1, t]) -
-                  1 * (x[ind0, t] - x[ind_2, t])) / (12 * h)
+        @return     { Hex digest }
+        """
+        ignore = ('t_ind', 'sigma', 'datafile_name', 'flag_write_output',
+                  'flag_callback', 'flag_callback_plot',
+                  'flag_callback_output', 'callback_steps', 'flag_init',
+                  'p_warm_push', 'p_warm_mu', 'voxels', 'octree')
+        key = hashlib.sha1(('%s %s %s;' % (ca.__version__, self.p_compiler,
+                                           self.p_cflags)).encode('utf-8'))
+        for options in (self.opt_opt, self.options):
+            for k in sorted(options):
+                if k not in ignore:
+                    key.update(('%s=%r;' % (k, options[k])).encode('utf-8'))
+        arrays = [self.voxels, self.fwd_matrix, np.array(self.y.shape)]
+        if self.screen is not None:
+            arrays.append(self.screen)
+        if self.pca is not None:
+            arrays.append(self.pca['components'])
+        for arg in arrays:
+            arg = np.ascontiguousarray(arg)
+            key.update(str(arg.shape).encode('utf-8'))
+            key.update(str(arg.dtype).encode('utf-8'))
+            key.update(arg.tobytes())
+        return key.hexdigest()
+
+    def get_compiled_nlp(self):
+        """
+        @brief      Generates C code for the NLP functions (objective,
+                    constraints and their derivatives) and compiles it to a
+                    shared library. Libraries are cached in cache_dir keyed by
+                    get_nlp_key, which is checked before any code is
+                    generated.
+        
+        @param      self  The optimization object
+        
+        @return     { Filename of the shared library }
+        """
+        if self.nlp_so is not None:
+            return self.nlp_so
+        cache_dir = os.path.abspath(os.path.join(self.options['cache_dir'],
+                                                 'codegen'))
+        if not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError as exc:  # Guard against race condition
+                if exc.errno != errno.EEXIST:
+                    raise
+        fname = os.path.join(cache_dir, 'nlp_' + self.get_nlp_key() + '.so')
+        if os.path.exists(fname):
+            print 'Loaded from cache: ' + fname
+            self.nlp_so = fname
+            return self.nlp_so
+        solver = ca.nlpsol("solver", "ipopt", self.nlp, self.opts)
+        # CasADi writes the code to the working directory
+        tmp_dir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            os.chdir(tmp_dir)
+            solver.generate_dependencies('nlp.c')
+            t0 = time.time()
+            subprocess.check_call([self.p_compiler, '-fPIC', '-shared'] +
+                                  self.p_cflags.split() +
+                                  ['nlp.c', '-o', 'nlp.so'])
+            shutil.move('nlp.so', fname + '.%d.tmp' % os.getpid())
+            os.rename(fname + '.%d.tmp' % os.getpid(), fname)
+            print "Compiled in %.3f seconds" % (time.time() - t0)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.nlp_so = fname
+        return self.nlp_so
+
+    def resolve(self, t_ind, sigma=None, flag_warm=False):
+        """
+        @brief      Solves the problem again for the window starting at
+                    t_ind with the solver of the last solve (requires
+                    flag_parametric unless the solver is FISTA). FISTA is
+                    warm started with the last solution shifted to the new
+                    window. IPOPT warm starts are not shifted, windows which
+                    overlap the last one are cold started.
+        
+        @param      self       The optimization object
+        @param      t_ind      First time point of the window
+        @param      sigma      Regularization weight, unchanged if None
+        @param      flag_warm  Start from the primal/dual solution of the
+                               last solve with IPOPT warm start options
+        
+        @return     { Result (x_size x t_int) }
+        """
+        if not self.flag_parametric and self.p_solver != 'fista':
+            raise ValueError('resolve needs flag_parametric')
+        p_shift = t_ind - self.t_ind
+        xres = getattr(self, 'xres', None)
+        self.set_measurements(t_ind)
+        if sigma is not None:
+            self.sigma_value = sigma
+        if self.p_solver == 'fista':
+            x0 = None
+            if flag_warm and xres is not None:
+                x0 = self.get_shifted_time_course(xres, p_shift)
+                if self.pca is not None:
+                    x0 = np.dot(x0, self.pca['components'].T)
+            self.solve_fista(x0=x0)
+            return self.xres
+        self.args["p"] = self.get_parameters()
+        if flag_warm and 0 < abs(p_shift) < self.t_int:
+            # columns of the last solution belong to other time samples
+            print "Window overlaps the last one, cold start"
+            flag_warm = False
+        if flag_warm:
+            if self.solver_warm is None:
+                opts = dict(self.opts)
+                opts["ipopt.warm_start_init_point"] = 'yes'
+                opts["ipopt.warm_start_bound_push"] = self.p_warm_push
+                opts["ipopt.warm_start_slack_bound_push"] = self.p_warm_push
+                opts["ipopt.warm_start_mult_bound_push"] = self.p_warm_push
+                opts["ipopt.mu_init"] = self.p_warm_mu
+                if self.flag_codegen:
+                    nlp = self.get_compiled_nlp()
+                else:
+                    nlp = self.nlp
+                self.solver_warm = ca.nlpsol("solver_warm", "ipopt", nlp, opts)
+            self.args["x0"] = self.res['x']
+            self.args["lam_x0"] = self.res['lam_x']
+            self.args["lam_g0"] = self.res['lam_g']
+            self.res = self.solver_warm(**self.args)
+            self.stats = self.solver_warm.stats()
         else:
-            ind1 = np.ravel_multi_index((i + 1, j, k), vx.shape)
-            ind_1 = np.ravel_multi_index((i - 1, j, k), vx.shape)
-            ind2 = np.ravel_multi_index((i + 2, j, k), vx.shape)
-            ind_2 = np.ravel_multi_index((i - 2, j, k), vx.shape)
-            # dx = 8(x1-x_1)-1(x2-x_2)
-            dx = (8 * (x[ind1, t] - x[ind_1, t]) -
-                  1 * (x[ind2, t] - x[ind_2, t])) / (12 * h)
-        return dx
+            self.initialize_variables()
+            self.args["x0"] = self.w0
+            self.args.pop("lam_x0", None)
+            self.args.pop("lam_g0", None)
+            self.res = self.solver(**self.args)
+            self.stats = self.solver.stats()
+        self.res_struct = self.w(self.res['x'])
+        self.xres = self.get_result()
+        return self.xres
 
-    def cmp_dy(self, smooth_entity, i, j, k, t, h=1.):
+    def get_shifted_time_course(self, x, p_shift):
         """
-        @brief      Computes the forward difference along y dimension.
+        @brief      Moves the time samples of x by p_shift, so x of the
+                    window at t_ind fits the window at t_ind + p_shift.
+                    Samples outside the old window repeat the nearest one.
         
-        @param      self           The optimization object
-        @param      smooth_entity  The image to smooth
-        @param      i              { pixel index for x - dimension}
-        @param      j              { pixel index for y - dimension}
-        @param      k              { pixel index for z - dimension}
-        @param      t              { time index }
-        @param      h              { discretization step }
+        @param      self     The optimization object
+        @param      x        The result (x_size x t_int)
+        @param      p_shift  Shift of the window
         
-        @return     { returns the y derivative for a single pixel }
+        @return     { Shifted result (x_size x t_int) }
         """
-        x = smooth_entity
-        vx, vy, vz = self.voxels
-        ni, nj, nk = vx.shape
-        ind0 = np.ravel_multi_index((i, j, k), vx.shape)
-        if j == 0:
-            # dx = 0 (1st order)
-            dy = 0
-        elif j == 1:
-            ind1 = np.ravel_multi_index((i, j + 1, k), vx.shape)
-            ind_1 = np.ravel_multi_index((i, j - 1, k), vx.shape)
-            ind2 = np.ravel_multi_index((i, j + 2, k), vx.shape)
-            # dy = 8(x1-x_1)-1(x2-x0) x0 instead of x_2 (2nd order)
-            dy = (8 * (x[ind1, t] - x[ind_1, t]) -
-                  1 * (x[ind2, t] - x[ind0, t])) / (12 * h)
-        elif j == nj - 1:
-            # dy = 0
-            dy = 0
-        elif j == nj - 2:
-            ind1 = np.ravel_multi_index((i, j + 1, k), vx.shape)
-            ind_1 = np.ravel_multi_index((i, j - 1, k), vx.shape)
-            ind_2 = np.ravel_multi_index((i, j - 2, k), vx.shape)
-            # dy = 8(x1-x_1)-1(x0-x_2) x0 instead of x2 (mirror)
-            dy = (8 * (x[ind1, t] - x[ind_1, t]) -
-                  1 * (x[ind0, t] - x[ind_2, t])) / (12 * h)
-        else:
-            if nj < 5:
-                print "Warning: 1st order differences due to size"
-                ind1 = np.ravel_multi_index((i, j + 1, k), vx.shape)
-                ind_1 = np.ravel_multi_index((i, j - 1, k), vx.shape)
-                # dy = (x1-x_1)/2h
-                dy = (8 * (x[ind1, t] - x[ind_1, t])) / (2 * h)
-            else:
-                ind1 = np.ravel_multi_index((i, j + 1, k), vx.shape)
-                ind_1 = np.ravel_multi_index((i, j - 1, k), vx.shape)
-                ind2 = np.ravel_multi_index((i, j + 2, k), vx.shape)
-                ind_2 = np.ravel_multi_index((i, j - 2, k), vx.shape)
-                # dy = 8(x1-x_1)-1(x2-x_2)
-                dy = (8 * (x[ind1, t] - x[ind_1, t]) -
-                      1 * (x[ind2, t] - x[ind_2, t])) / (12 * h)
-        return dy
+        ind = np.clip(np.arange(x.shape[1]) + p_shift, 0, x.shape[1] - 1)
+        return x[:, ind]
 
-    def cmp_dz(self, smooth_entity, i, j, k, t, h=1.):
+    def get_solve_function(self):
         """
-        @brief      Computes the forward difference along z dimension.
+        @brief      Solve method for self.method
         
-        @param      self           The optimization object
-        @param      smooth_entity  The image to smooth
-        @param      i              { pixel index for x - dimension}
-        @param      j              { pixel index for y - dimension}
-        @param      k              { pixel index for z - dimension}
-        @param      t              { time index }
-        @param      h              { discretization step }
+        @param      self  The optimization object
         
-        @return     { returns the z derivative for a single pixel }
+        @return     { Bound solve method }
+        """
+        if self.p_solver == 'fista':
+            if self.method not in ('slack', '2p'):
+                raise ValueError("solver 'fista' supports the methods 2p "
+                                 "and slack, not %s" % self.method)
+            return self.solve_fista
+        return {'slack': self.solve_ipopt_multi_measurement_slack,
+                '2p': self.solve_ipopt_multi_measurement_2p,
+                'thesis': self.solve_ipopt_multi_measurement_thesis,
+                'mask': self.solve_ipopt_multi_measurement_only_mask,
+                'dipole': self.solve_dipole}[self.method]
+
+    def solve_batch(self, windows, p_workers=None, p_offset=None, p_chunk=1):
+        """
+        @brief      Localizes many windows in parallel. Every worker process
+                    builds one optimization object and solver and re-solves
+                    it (flag_parametric) for each of its windows. Windows
+                    are clamped to the recording, so events near its ends
+                    are off centre.
+        
+        @param      self       The optimization object
+        @param      windows    First time points of the windows or detected
+                               events (data.events)
+        @param      p_workers  Number of processes, all cores if None
+        @param      p_offset   Window start before an event, t_int / 2 if
+                               None
+        @param      p_chunk    Windows sent to a worker at once
+        
+        @return     { Generator of (t_ind, xres) in completion order }
+        """
+        windows = np.asarray(windows)
+        if windows.dtype.names is not None:
+            if p_offset is None:
+                p_offset = self.t_int // 2
+            windows = windows['t_ind'] - p_offset
+        n_t = self.data.electrode_rec.shape[1]
+        windows = np.clip(windows, 0, n_t - self.t_int)
+        options = dict(self.options)
+        options.update(self.opt_opt)
+        options.update({'voxels': self.voxels,
+                        'octree': self.octree,
+                        'flag_parametric': True,
+                        'flag_callback': False,
+                        'flag_write_output': False})
+        pool = Pool(p_workers, init_batch_worker, (self.data, options))
+        try:
+            for res in pool.imap_unordered(solve_batch_window,
+                                           [int(t) for t in windows],
+                                           p_chunk):
+                yield res
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def solve_sliding_window(self, t_start, t_stop, p_step=None):
+        """
+        @brief      Localizes consecutive windows between t_start and t_stop,
+                    each window is warm started from the solution of the
+                    previous one, see resolve (requires flag_parametric
+                    unless the solver is FISTA)
+        
+        @param      self     The optimization object
+        @param      t_start  First time point of the first window
+        @param      t_stop   Last time point (exclusive) of the windows
+        @param      p_step   Shift between windows, t_int if None
+        
+        @return     { List of dictionaries with t_ind, xres, iter_count and
+                      return_status per window }
+        """
+        if not self.flag_parametric and self.p_solver != 'fista':
+            raise ValueError('solve_sliding_window needs flag_parametric')
+        if p_step is None:
+            p_step = self.t_int
+        windows = []
+        for t_ind in range(t_start, t_stop - self.t_int + 1, p_step):
+            if not windows:
+                # cold start builds the solver
+                self.set_measurements(t_ind)
+                self.get_solve_function()()
+            else:
+                self.resolve(t_ind, flag_warm=True)
+            windows.append({'t_ind': t_ind,
+                            'xres': self.xres,
+                            'iter_count': self.stats['iter_count'],
+                            'return_status': self.stats['return_status']})
+            print "Window %d: %d iterations" % (t_ind, self.stats['iter_count'])
+        return windows
+
+    def get_voxel_score(self):
         """
-        x = smooth_entity
-        vx, vy, vz = self.voxels
-        ni, nj, nk = vx.shape
-        ind0 = np.ravel_multi_index((i, j, k), vx.shape)
-        if k == 0:
-            # dz = 0 (1st order)
-            dz = 0
-        elif k == 1:
-            ind1 = np.ravel_multi_index((i, j, k + 1), vx.shape)
-            ind_1 = np.ravel_multi_index((i, j, k - 1), vx.shape)
-            ind2 = np.ravel_multi_index((i, j, k + 2), vx.shape)
-            # dx = 8(x1-x_1)-1(x2-x0) x0 instead of x_2 (2nd order)
-            dz = (8 * (x[ind1, t] - x[ind_1, t]) -
-                  1 * (x[ind2, t] - x[ind0, t])) / (12 * h)
-        elif k == nk - 1:
-            # dx = 0
-            dz = 0
-        elif k == nk - 2:
-            ind1 = np.ravel_multi_index((i, j, k + 1), vx.shape)
-            ind_1 = np.ravel_multi_index((i, j, k - 1), vx.shape)
-            ind_2 = np.ravel_multi_index((i, j, k - 2), vx.shape)
-            # dx = 8(x1-x_1)-1(x0-x_2) x0 instead of x2 (mirror)
-            dz = (8 * (x[ind1, t] - x[ind_1, t]) -
-                  1 * (x[ind0, t] - x[ind_2, t])) / (12 * h)
+        @brief      Activity of every voxel in the last solve, max |x| over
+                    time (times the mask m for thesis), normalized to 1
+        
+        @param      self  The optimization object
+        
+        @return     { Score (x_size) }
+        """
+        score = np.max(np.abs(self.xres), 1)
+        if self.method == 'thesis' and self.p_solver != 'fista':
+            m = self.res_struct['m'].full().flatten()
+            if self.screen is not None:
+                m_full = np.zeros(self.screen.shape[0])
+                m_full[self.screen] = m
+                m = m_full
+            score = score * np.abs(m)
+        return score / max(np.max(score), 1e-300)
+
+    def create_refined_voxels(self, keep, p_margin=1):
+        """
+        @brief      Voxels with half the spacing of the current ones, only in
+                    the patches within p_margin voxels of the kept voxels.
+                    The patches are an octree of unit leaves on the grid with
+                    half the spacing, grid points outside them are labelled
+                    -1. The current voxels must be a regular grid or a
+                    previous refinement.
+        
+        @param      self      The optimization object
+        @param      keep      Boolean mask of the voxels to refine (x_size)
+        @param      p_margin  Coarse voxels added around every kept voxel
+        
+        @return     { (Voxels (3 x n_v), octree) }
+        """
+        if self.octree is not None and np.all(self.octree['size'] == 1):
+            origin = self.octree['origin']
+            h = self.octree['spacing']
+            labels = self.octree['labels']
+        elif self.grid is not None and np.allclose(self.grid['spacing'],
+                                                   self.grid['spacing'][0]):
+            origin = self.voxels[:, 0, 0, 0]
+            h = self.grid['spacing'][0]
+            labels = np.arange(self.voxels[0].size).reshape(
+                self.grid['shape'])
+        else:
+            raise ValueError('refinement needs an isotropic regular voxel '
+                             'grid or a refined one')
+        exists = labels >= 0
+        patch = exists & keep[labels]
+        if p_margin > 0:
+            patch = binary_dilation(patch, np.ones((3, 3, 3), dtype=bool),
+                                    p_margin) & exists
+        # fine point i lies between the coarse points i // 2 and (i + 1) // 2,
+        # it is refined if they all are, so a single patch is a box
+        shape = tuple(2 * n - 1 for n in labels.shape)
+        up = patch.repeat(2, 0).repeat(2, 1).repeat(2, 2)
+        fine = np.ones(shape, dtype=bool)
+        for s in np.indices((2, 2, 2)).reshape(3, 8).T:
+            fine &= up[s[0]:s[0] + shape[0], s[1]:s[1] + shape[1],
+                       s[2]:s[2] + shape[2]]
+        corner = np.array(np.nonzero(fine))
+        n_v = corner.shape[1]
+        labels = -np.ones(shape, dtype=int)
+        labels[fine] = np.arange(n_v)
+        octree = {'origin': origin,
+                  'spacing': h / 2.,
+                  'shape': shape,
+                  'corner': corner,
+                  'size': np.ones(n_v, dtype=int),
+                  'labels': labels,
+                  'neighbours': self.cmp_octree_neighbours(labels, n_v)}
+        return origin[:, None] + corner * h / 2., octree
+
+    def get_prolongated_variables(self, voxels, p_scale=1.):
+        """
+        @brief      Prolongates the solution of the last solve to voxels by
+                    nearest neighbour interpolation
+        
+        @param      self     The optimization object
+        @param      voxels   The new voxels (3 x ...)
+        @param      p_scale  Factor for the charges, the ratio of the voxel
+                             volumes
+        
+        @return     { Dictionary of variable values for w_init }
+        """
+        vox_old = self.voxels.reshape(3, -1).T
+        vox_new = voxels.reshape(3, -1).T
+        nearest = cKDTree(vox_old).query(vox_new)[1]
+        w_init = {}
+        for key in self.w.keys():
+            value = self.res_struct[key].full()
+            if key == 'ys':
+                w_init[key] = value
+                continue
+            if self.screen is not None:
+                # screened voxels are zero
+                value_full = np.zeros((self.screen.shape[0], value.shape[1]))
+                value_full[self.screen] = value
+                value = value_full
+            value = value[nearest]
+            if key in ('x', 'xs', 'xs_pos', 'xs_neg', 'a'):
+                value = value * p_scale
+            w_init[key] = value
+        return w_init
+
+    def solve_multires(self, p_levels=None, p_thresh=None, p_margin=None):
+        """
+        @brief      Coarse to fine localization. The problem is solved on the
+                    current grid, then with half the spacing in the patches
+                    around the voxels whose score (see get_voxel_score)
+                    exceeds p_thresh (see create_refined_voxels), each level
+                    is warm started with the prolongated solution of the
+                    previous one.
+        
+        @param      self      The optimization object
+        @param      p_levels  Number of levels, p_mr_levels if None
+        @param      p_thresh  Score threshold for refinement, p_mr_thresh if
+                              None
+        @param      p_margin  Coarse voxels added around every refined voxel,
+                              p_mr_margin if None
+        
+        @return     { List of dictionaries with voxels, xres and n_voxels per
+                      level, the object holds the finest level }
+        """
+        if p_levels is None:
+            p_levels = self.p_mr_levels
+        if p_thresh is None:
+            p_thresh = self.p_mr_thresh
+        if p_margin is None:
+            p_margin = self.p_mr_margin
+        levels = []
+        try:
+            for level in range(p_levels):
+                if level > 0:
+                    keep = self.get_voxel_score() > p_thresh
+                    voxels, octree = self.create_refined_voxels(keep,
+                                                                p_margin)
+                    if self.p_solver != 'fista':
+                        # a voxel splits into 8 of half the spacing
+                        self.w_init = self.get_prolongated_variables(
+                            voxels, 0.125)
+                    self.set_voxels(voxels, octree=octree)
+                t0 = time.time()
+                self.get_solve_function()()
+                n_voxels = self.fwd_matrix.shape[1]
+                print "Level %d: %d voxels in %.3f seconds" % (
+                    level, n_voxels, time.time() - t0)
+                levels.append({'voxels': self.voxels,
+                               'xres': self.xres,
+                               'n_voxels': n_voxels})
+        finally:
+            self.w_init = None
+        return levels
+
+    def cmp_cent_stencil(self, n, h=1., flag_first=False):
+        """
+        @brief      Central difference stencil along one grid dimension,
+                    4th order inside and mirrored at the borders.
+        
+        @param      self        The optimization object
+        @param      n           { number of pixels along the dimension }
+        @param      h           { discretization step }
+        @param      flag_first  { 1st order inside if n < 5 (y dimension) }
+        
+        @return     { n x n scipy.sparse stencil }
+        """
+        rows, cols, vals = [], [], []
+        for i in range(n):
+            if i == 0 or (i == n - 1 and i != 1):
+                # dx = 0
+                continue
+            elif i == 1:
+                # dx = 8(x1-x_1)-1(x2-x0) x0 instead of x_2 (2nd order)
+                ind = [i + 1, i - 1, i + 2, i]
+                val = [8., -8., -1., 1.]
+                if i + 2 >= n:
+                    raise ValueError('invalid entry in coordinates array')
+            elif i == n - 2:
+                # dx = 8(x1-x_1)-1(x0-x_2) x0 instead of x2 (mirror)
+                ind = [i + 1, i - 1, i, i - 2]
+                val = [8., -8., -1., 1.]
+            elif flag_first and n < 5:
+                print "Warning: 1st order differences due to size"
+                # dx = (x1-x_1)/2h
+                ind = [i + 1, i - 1]
+                val = [8. * 12 / 2, -8. * 12 / 2]
+            else:
+                # dx = 8(x1-x_1)-1(x2-x_2)
+                ind = [i + 1, i - 1, i + 2, i - 2]
+                val = [8., -8., -1., 1.]
+            rows += [i] * len(ind)
+            cols += ind
+            vals += val
+        return coo_matrix((np.array(vals) / (12 * h), (rows, cols)),
+                          shape=(n, n)).tocsr()
+
+    def cmp_fwd_stencil(self, n, flag_average=False, h=1.):
+        """
+        @brief      Forward difference (or average) stencil along one grid
+                    dimension, backward at the last pixel.
+        
+        @param      self          The optimization object
+        @param      n             { number of pixels along the dimension }
+        @param      flag_average  The flag to get mask average
+        @param      h             { discretization step }
+        
+        @return     { n x n scipy.sparse stencil }
+        """
+        ind0 = np.arange(n)
+        ind1 = ind0 + 1
+        ind1[-1] = n - 2
+        if n < 2:
+            raise ValueError('invalid entry in coordinates array')
+        if flag_average:
+            vals = np.ones(2 * n) / 2.
         else:
-            ind1 = np.ravel_multi_index((i, j, k + 1), vx.shape)
-            ind_1 = np.ravel_multi_index((i, j, k - 1), vx.shape)
-            ind2 = np.ravel_multi_index((i, j, k + 2), vx.shape)
-            ind_2 = np.ravel_multi_index((i, j, k - 2), vx.shape)
-            # dx = 8(x1-x_1)-1(x2-x_2)
-            dz = (8 * (x[ind1, t] - x[ind_1, t]) -
-                  1 * (x[ind2, t] - x[ind_2, t])) / (12 * h)
-        return dz
+            vals = np.hstack([np.ones(n), -np.ones(n)]) / h
+        return coo_matrix((vals, (np.hstack([ind0, ind0]),
+                                  np.hstack([ind1, ind0]))),
+                          shape=(n, n)).tocsr()
+
+    def cmp_octree_weights(self, adjacency, center):
+        """
+        @brief      Interpolation weights onto the face of the octree leaves
+                    and the distance to it along one dimension
+        
+        @param      self       The optimization object
+        @param      adjacency  Face areas to the neighbours on one side
+                               (n_v x n_v)
+        @param      center     Leaf centers along the dimension (grid steps)
+        
+        @return     { (Weights normalized per leaf, distance, mask of the
+                      leaves which have neighbours) }
+        """
+        area = np.asarray(adjacency.sum(1)).flatten()
+        has = area > 0
+        weights = diags(1. / np.maximum(area, 1)).dot(adjacency).tocsr()
+        dist = np.abs(weights.dot(center) - center * has)
+        return weights, np.where(has, dist, 1), has
+
+    def cmp_octree_stencil(self, d, flag_fwd=False, flag_average=False, h=1.):
+        """
+        @brief      Difference (or average) stencil along dimension d of the
+                    octree. Neighbours on a side are averaged with their face
+                    areas, the distance is the mean distance to them in steps
+                    of the finest level. Forward differences turn backward
+                    where there is no neighbour, central differences are 2nd
+                    order and zero at the borders.
+        
+        @param      self          The optimization object
+        @param      d             The dimension
+        @param      flag_fwd      Forward instead of central differences
+        @param      flag_average  The flag to get mask average (forward only)
+        @param      h             { discretization step }
+        
+        @return     { n_v x n_v scipy.sparse stencil }
+        """
+        size = self.octree['size']
+        center = self.octree['corner'][d] + (size - 1) / 2.
+        nv = size.shape[0]
+        adjacency = self.octree['neighbours'][d]
+        w_pos, d_pos, has_pos = self.cmp_octree_weights(adjacency, center)
+        w_neg, d_neg, has_neg = self.cmp_octree_weights(
+            adjacency.T.tocsr(), center)
+        eye = identity(nv, format='csr')
+        bwd = ~has_pos & has_neg
+        if flag_fwd and flag_average:
+            return (diags(has_pos / 2.).dot(eye + w_pos) +
+                    diags(bwd / 2.).dot(eye + w_neg) +
+                    diags(1. * ~(has_pos | has_neg))).tocsr()
+        if flag_fwd:
+            return (diags(has_pos / d_pos / h).dot(w_pos - eye) +
+                    diags(bwd / d_neg / h).dot(w_neg - eye)).tocsr()
+        both = has_pos & has_neg
+        return diags(both / (d_pos + d_neg) / h).dot(w_pos - w_neg).tocsr()
+
+    def get_diff_operator(self, flag_fwd=False, flag_average=False, h=1.):
+        """
+        @brief      Sparse difference operator for the voxel grid or octree.
+                    Rows are interleaved (dx, dy, dz) per voxel so the
+                    gradient of a field x is reshape(D x, 3, n_v). Operators
+                    are cached per grid shape.
+        
+        @param      self          The optimization object
+        @param      flag_fwd      Forward instead of central differences
+        @param      flag_average  The flag to get mask average (forward only)
+        @param      h             { discretization step }
+        
+        @return     { (scipy.sparse operator, CasADi DM operator) }
+        """
+        shape = tuple(self.voxels.shape[1:])
+        key = (shape, flag_fwd, flag_average, h)
+        if key not in self.diff_ops:
+            nv = int(np.prod(shape))
+            if self.octree is not None:
+                ops = [self.cmp_octree_stencil(d, flag_fwd, flag_average, h)
+                       for d in range(3)]
+            else:
+                ops = []
+                for d, n in enumerate(shape):
+                    if flag_fwd:
+                        stencil = self.cmp_fwd_stencil(n, flag_average, h)
+                    else:
+                        stencil = self.cmp_cent_stencil(n, h,
+                                                        flag_first=(d == 1))
+                    # Stencil along dimension d, identity along the others
+                    op = identity(1, format='csr')
+                    for e, m in enumerate(shape):
+                        op = kron(op, stencil if e == d else identity(m),
+                                  format='csr')
+                    ops.append(op)
+            perm = np.arange(3 * nv).reshape(3, nv).T.flatten()
+            op = vstack(ops, format='csr')[perm].tocsc()
+            op.sort_indices()
+            op_ca = ca.DM(ca.Sparsity(op.shape[0], op.shape[1],
+                                      op.indptr.tolist(), op.indices.tolist()),
+                          op.data)
+            self.diff_ops[key] = (op, op_ca)
+        return self.diff_ops[key]
 
     def cmp_gradient(self, smooth_entity, flag_tmp_smooth=False, h=1., flag_second=False):
         """
-        @brief      Computes the forward difference for the whole volume.
+        @brief      Computes the central difference for the whole volume.
         
         @param      self             {The optimization object}
         @param      smooth_entity    {The image to smooth}
         @param      flag_tmp_smooth  {The flag temporary smooth}
         @param      h                {discretization step}
         @param      flag_second      {The flag for second order approxiamion}
-        @param      t     {time index}
         
         @return     { returns the gradient for a the whole image }
         """
         # initials
         x = smooth_entity
-        vx, vy, vz = self.voxels
-        ni, nj, nk = vx.shape
-        nv = ni * nj * nk
+        nv = self.x_size
         if x.shape[0] != nv:
             nt = nv / x.shape[0]
         else:
             nt = 1
-        # print "Time point(s): ", nt
-        # loop over the voxels
-        for t in range(nt):
-            for i in range(ni):
-                for j in range(nj):
-                    for k in range(nk):
-                        ind = np.ravel_multi_index((i, j, k), vx.shape)
-                        if ind == 0:
-                            grad_mtr = [sum([self.cmp_dx(smooth_entity, i, j, k, t, h)]) + 1e-20,
-                                        sum([self.cmp_dy(smooth_entity,
-                                                         i, j, k, t, h)]) + 1e-20,
-                                        sum([self.cmp_dz(smooth_entity, i, j, k, t, h)]) + 1e-20]
-                        else:
-                            grad_mtr = ca.horzcat(grad_mtr,
-                                                  ca.vertcat(sum([self.cmp_dx(smooth_entity, i, j, k, t, h)]),
-                                                             sum([self.cmp_dy(
-                                                                 smooth_entity, i, j, k, t, h)]),
-                                                             sum([self.cmp_dz(smooth_entity, i, j, k, t, h)])) + 1e-20)
+        op = self.get_diff_operator(False, False, h)[1]
+        grad_mtr = ca.horzcat(*[ca.reshape(ca.mtimes(op, x[:, t]), 3, nv)
+                                for t in range(nt)]) + 1e-20
         if flag_tmp_smooth:
             # compute temporal gradient
             print "Temporal smoothness enforced."
         return grad_mtr
 
-    def cmp_fwd_dx(self, smooth_entity, flag_average, i, j, k, t, h=1.):
-        """
-        @brief      Computes the forward difference along x dimension.
-        
-        @param      self           The optimization object
-        @param      smooth_entity  The image to smooth
-        @param      flag_average   The flag to get mask average
-        @param      i              { pixel index for x - dimension}
-        @param      j              { pixel index for y - dimension}
-        @param      k              { pixel index for z - dimension}
-        @param      t              { time index }
-        @param      h              { discretization step }
-        
-        @return     { returns the gradient for a single pixel }
-        """
-        x = smooth_entity
-        vx, vy, vz = self.voxels
-        ni, nj, nk = vx.shape
-        ind0 = np.ravel_multi_index((i, j, k), vx.shape)
-        if i == ni - 1:
-            ind1 = np.ravel_multi_index((i - 1, j, k), vx.shape)
-            ind0 = np.ravel_multi_index((i, j, k), vx.shape)
-        else:
-            ind1 = np.ravel_multi_index((i + 1, j, k), vx.shape)
-            ind0 = np.ravel_multi_index((i, j, k), vx.shape)
-        if flag_average:
-            dx = (x[ind1, t] + x[ind0, t]) / 2.
-        else:
-            dx = (x[ind1, t] - x[ind0, t]) / h
-        return dx
-
-    def cmp_fwd_dy(self, smooth_entity, flag_average, i, j, k, t, h=1.):
-        """
-        Computes the forward difference along y dimension.
-
-        @param      self           The optimization object
-        @param      smooth_entity  The image to smooth
-        @param      flag_average   The flag to get mask average
-        @param      i              { pixel index for x - dimension}
-        @param      j              { pixel index for y - dimension}
-        @param      k              { pixel index for z - dimension}
-        @param      t              { time index }
-        @param      h              { discretization step }
-
-        @return     { returns the gradient for a single pixel }
-        """
-        x = smooth_entity
-        vx, vy, vz = self.voxels
-        ni, nj, nk = vx.shape
-        ind0 = np.ravel_multi_index((i, j, k), vx.shape)
-        if j == nj - 1:
-            ind1 = np.ravel_multi_index((i, j - 1, k), vx.shape)
-            ind0 = np.ravel_multi_index((i, j, k), vx.shape)
-        else:
-            ind1 = np.ravel_multi_index((i, j + 1, k), vx.shape)
-            ind0 = np.ravel_multi_index((i, j, k), vx.shape)
-        if flag_average:
-            dy = (x[ind1, t] + x[ind0, t]) / 2.
-        else:
-            dy = (x[ind1, t] - x[ind0, t]) / h
-        return dy
-
-    def cmp_fwd_dz(self, smooth_entity, flag_average, i, j, k, t, h=1.):
-        """
-        @brief      Computes the forward difference along z dimension.
-        
-        @param      self           The optimization object
-        @param      smooth_entity  The image to smooth
-        @param      flag_average   The flag to get mask average
-        @param      i              { pixel index for x - dimension}
-        @param      j              { pixel index for y - dimension}
-        @param      k              { pixel index for z - dimension}
-        @param      t              { time index }
-        @param      h              { discretization step }
-        
-        @return     { returns the gradient for a single pixel }
-        """
-        x = smooth_entity
-        vx, vy, vz = self.voxels
-        ni, nj, nk = vx.shape
-        ind0 = np.ravel_multi_index((i, j, k), vx.shape)
-        if k == nk - 1:
-            ind1 = np.ravel_multi_index((i, j, k - 1), vx.shape)
-            ind0 = np.ravel_multi_index((i, j, k), vx.shape)
-        else:
-            ind1 = np.ravel_multi_index((i, j, k + 1), vx.shape)
-            ind0 = np.ravel_multi_index((i, j, k), vx.shape)
-        if flag_average:
-            dz = (x[ind1, t] + x[ind0, t]) / 2.
-        else:
-            dz = (x[ind1, t] - x[ind0, t]) / h
-        return dz
-
     def cmp_fwd_diff(self, smooth_entity, flag_average=False, flag_tmp_smooth=False, h=1., flag_second=False):
         """
         @brief      { Compute forward difference }
@@ -759,9 +1271,7 @@ class opt_out(data_out):
         """
         # initials
         x = smooth_entity
-        vx, vy, vz = self.voxels
-        ni, nj, nk = vx.shape
-        nv = ni * nj * nk
+        nv = self.x_size
         if flag_average:
             epsilon = 0
         else:
@@ -770,32 +1280,13 @@ class opt_out(data_out):
             nt = nv / x.shape[0]
         else:
             nt = 1
-        # loop over the voxels
-        for t in range(nt):
-            for i in range(ni):
-                for j in range(nj):
-                    for k in range(nk):
-                        if i == j == k == 0:
-                            grad_fwd = ca.vertcat(sum([self.cmp_fwd_dx(smooth_entity, flag_average, i, j, k, t, h)]) + epsilon,
-                                                  sum([self.cmp_fwd_dy(
-                                                      smooth_entity, flag_average, i, j, k, t, h)]) + epsilon,
-                                                  sum([self.cmp_fwd_dz(smooth_entity, flag_average, i, j, k, t, h)]) + epsilon)
-                        else:
-                            grad_fwd = ca.horzcat(grad_fwd,
-                                                  ca.vertcat(sum([self.cmp_fwd_dx(smooth_entity, flag_average, i, j, k, t, h)]),
-                                                             sum([self.cmp_fwd_dy(
-                                                                 smooth_entity, flag_average, i, j, k, t, h)]),
-                                                             sum([self.cmp_fwd_dz(smooth_entity, flag_average, i, j, k, t, h)])) + epsilon)
+        op = self.get_diff_operator(True, flag_average, h)[1]
+        grad_fwd = ca.horzcat(*[ca.reshape(ca.mtimes(op, x[:, t]), 3, nv)
+                                for t in range(nt)]) + epsilon
         if flag_tmp_smooth:
             # compute temporal gradient
             print "Temporal smoothness enforced."
-        if self.flag_parallel:
-            print smooth_entity.T.shape, grad_fwd.shape
-            # gr = ca.Function('gr',[smooth_entity.T],[grad_fwd])
-            # return gr_map(smooth_entity)
-            return gr
-        else:
-            return grad_fwd
+        return grad_fwd
 
     def write_casadi_structure(self, struct_to_save):
         """
@@ -863,7 +1354,7 @@ class opt_out(data_out):
         
         @return     { None }
         """
-        self.w = struct_symMX([entry("x", shape=(self.x_size, self.t_int)),
+        self.w = struct_symMX([entry("x", shape=(self.x_size, self.t_size)),
                                entry("xs", shape=(self.x_size)),
                                entry("ys", shape=(self.y.shape))])
         self.x, self.xs, self.ys = self.w[...]
@@ -883,12 +1374,12 @@ class opt_out(data_out):
         
         @return     { None }
         """
-        for i in range(self.y.shape[0]):
-            for ti in range(self.t_int):
-                self.f += (self.y[i, ti] - self.ys[i, ti])**2
-                self.g.append(self.ys[i, ti] - ca.dot(self.fwd[i, :].T, self.x[:, ti]))
-                self.lbg.append(0)
-                self.ubg.append(0)
+        n_g = self.y.shape[0] * self.t_size
+        self.f += ca.sumsqr(self.yp - self.ys)
+        # one matrix constraint, rows ordered electrode by electrode
+        self.g.append(ca.vec((self.ys - ca.mtimes(self.fwd, self.x)).T))
+        self.lbg.append(ca.DM.zeros(n_g))
+        self.ubg.append(ca.DM.zeros(n_g))
 
     def add_l1_costs_constraints_slack(self):
         """
@@ -898,20 +1389,14 @@ class opt_out(data_out):
         
         @return     { None }
         """
-        for j in range(self.w['xs'].shape[0]):
-            tmp = 0
-            for tj in range(self.t_int):
-                tmp += self.w['x'][j, tj]**2
-            self.f += self.sigma_value * (self.xs[j])
-            self.g.append(-self.xs[j] - tmp)
-            self.g.append(-self.xs[j] + tmp)
-            self.g.append(-self.xs[j])
-            self.lbg.append(-ca.inf)
-            self.lbg.append(-ca.inf)
-            self.lbg.append(-ca.inf)
-            self.ubg.append(0.)
-            self.ubg.append(0.)
-            self.ubg.append(0.)
+        n_g = 3 * self.x_size
+        tmp = ca.sum2(self.x**2)
+        self.f += self.sp * ca.sum1(self.xs)
+        # rows ordered voxel by voxel
+        self.g.append(ca.vec(ca.horzcat(-self.xs - tmp, -self.xs + tmp,
+                                        -self.xs).T))
+        self.lbg.append(-ca.inf * ca.DM.ones(n_g))
+        self.ubg.append(ca.DM.zeros(n_g))
 
     def solve_ipopt_multi_measurement_slack(self):
         """
@@ -922,6 +1407,7 @@ class opt_out(data_out):
         @return     { None }
         """
         t0 = time.time()
+        self.apply_screening()
         self.set_optimization_variables_slack()
         self.add_data_costs_constraints_slack()
         self.add_l1_costs_constraints_slack()
@@ -937,7 +1423,7 @@ class opt_out(data_out):
             save_this['opts'] = self.opt_opt
             self.write_with_pickle(save_this)
             self.write_casadi_structure(self.res_struct)
-        self.xres = self.res_struct['x'].full()
+        self.xres = self.get_result()
 
     def set_optimization_variables_2p(self):
         """
@@ -948,8 +1434,8 @@ class opt_out(data_out):
         
         @return     { None }
         """
-        self.w = struct_symMX([entry("xs_pos", shape=(self.x_size, self.t_int)),
-                               entry("xs_neg", shape=(self.x_size, self.t_int)),
+        self.w = struct_symMX([entry("xs_pos", shape=(self.x_size, self.t_size)),
+                               entry("xs_neg", shape=(self.x_size, self.t_size)),
                                entry("ys", shape=(self.y.shape))])
         self.xs_pos, self.xs_neg, self.ys = self.w[...]
         self.g = []
@@ -968,12 +1454,12 @@ class opt_out(data_out):
         
         @return     { None }
         """
-        for i in range(self.y.shape[0]):
-            for ti in range(self.t_int):
-                self.f += (self.y[i, ti] - self.ys[i, ti])**2
-                self.g.append(self.ys[i, ti] - ca.dot(self.fwd[i, :].T, (self.xs_pos[:, ti] - self.xs_neg[:, ti])))
-                self.lbg.append(0)
-                self.ubg.append(0)
+        n_g = self.y.shape[0] * self.t_size
+        self.f += ca.sumsqr(self.yp - self.ys)
+        # one matrix constraint, rows ordered electrode by electrode
+        self.g.append(ca.vec((self.ys - ca.mtimes(self.fwd, self.xs_pos - self.xs_neg)).T))
+        self.lbg.append(ca.DM.zeros(n_g))
+        self.ubg.append(ca.DM.zeros(n_g))
 
     def add_l1_costs_constraints_2p(self):
         """
@@ -983,19 +1469,14 @@ class opt_out(data_out):
         
         @return     { None }
         """
-        for j in range(self.xs_pos.shape[0]):
-            tmp_pos = 0
-            tmp_neg = 0
-            for tj in range(self.t_int):
-                tmp_pos += self.xs_pos[j, tj]
-                tmp_neg += self.xs_neg[j, tj]
-                self.g.append(-self.xs_pos[j, tj])
-                self.g.append(-self.xs_neg[j, tj])
-                self.lbg.append(-ca.inf)
-                self.lbg.append(-ca.inf)
-                self.ubg.append(0.)
-                self.ubg.append(0.)
-            self.f += self.sigma_value * (tmp_pos + tmp_neg)
+        n_g = 2 * self.x_size * self.t_size
+        # rows ordered voxel by voxel, then time, then sign
+        self.g.append(-ca.vec(ca.vertcat(ca.vec(self.xs_pos.T).T,
+                                         ca.vec(self.xs_neg.T).T)))
+        self.lbg.append(-ca.inf * ca.DM.ones(n_g))
+        self.ubg.append(ca.DM.zeros(n_g))
+        self.f += self.sp * (ca.sum1(ca.sum2(self.xs_pos)) +
+                            ca.sum1(ca.sum2(self.xs_neg)))
 
     def solve_ipopt_multi_measurement_2p(self):
         """
@@ -1006,6 +1487,12 @@ class opt_out(data_out):
         @return     { None }
         """
         t0 = time.time()
+        self.apply_screening()
+        if self.x_size == 0:
+            print "Screening removed every voxel, the solution is zero"
+            self.xres = self.project_result(
+                np.zeros((self.screen.shape[0], self.t_size)))
+            return
         self.set_optimization_variables_2p()
         self.add_data_costs_constraints_2p()
         self.add_l1_costs_constraints_2p()
@@ -1021,7 +1508,7 @@ class opt_out(data_out):
             save_this['opts'] = self.opt_opt
             self.write_with_pickle(save_this)
             self.write_casadi_structure(self.res_struct)
-        self.xres = self.res_struct['xs_pos'].full() - self.res_struct['xs_neg'].full()
+        self.xres = self.get_result()
 
     def set_optimization_variables_thesis(self):
         """
@@ -1031,7 +1518,7 @@ class opt_out(data_out):
         
         @return     { None }
         """
-        self.w = struct_symMX([entry("a", shape=(self.x_size, self.t_int)),
+        self.w = struct_symMX([entry("a", shape=(self.x_size, self.t_size)),
                                entry("m", shape=(self.x_size)),
                                entry("s", shape=(self.x_size, 3)),
                                entry("ys", shape=(self.y.shape)),
@@ -1057,17 +1544,16 @@ class opt_out(data_out):
         
         @return     { None }
         """
-        for i in range(self.y.shape[0]):
-            for ti in range(self.t_int):
-                # self.f += (self.y[i, ti] - self.ys[i, ti])**2
-                if self.flag_data_mask:
-                    # self.g.append(self.ys[i, ti] - ca.dot(self.fwd[i, :].T, self.a[:, ti] * self.m))
-                    self.g.append(self.y[i, ti] - ca.dot(self.fwd[i, :].T, self.a[:, ti] * self.m))
-                else:
-                    # self.g.append(self.ys[i, ti] - ca.dot(self.fwd[i, :].T, self.a[:, ti]))
-                    self.g.append(self.y[i, ti] - ca.dot(self.fwd[i, :].T, self.a[:, ti]))
-                self.lbg.append(0)
-                self.ubg.append(0)
+        n_g = self.y.shape[0] * self.t_size
+        # self.f += ca.sumsqr(self.yp - self.ys)
+        if self.flag_data_mask:
+            x = self.a * ca.repmat(self.m, 1, self.t_size)
+        else:
+            x = self.a
+        # one matrix constraint, rows ordered electrode by electrode
+        self.g.append(ca.vec((self.yp - ca.mtimes(self.fwd, x)).T))
+        self.lbg.append(ca.DM.zeros(n_g))
+        self.ubg.append(ca.DM.zeros(n_g))
 
     def solve_dipole(self):
         """
@@ -1077,8 +1563,8 @@ class opt_out(data_out):
         
         @return     { None }
         """
-        self.w = struct_symMX([entry("x_pos", shape=[self.x_size, self.t_int]),
-                               entry("x_neg", shape=[self.x_size, self.t_int]),
+        self.w = struct_symMX([entry("x_pos", shape=[self.x_size, self.t_size]),
+                               entry("x_neg", shape=[self.x_size, self.t_size]),
                                entry("m_pos", shape=self.x_size),
                                entry("m_neg", shape=self.x_size),
                                ])
@@ -1103,7 +1589,7 @@ class opt_out(data_out):
             self.lbg.append(0)
             self.ubg.append(ca.inf)
             self.ubg.append(ca.inf)
-            for ftj in range(self.t_int):
+            for ftj in range(self.t_size):
                 self.g.append(self.x_pos[fj, ftj])
                 self.g.append(self.x_neg[fj, ftj])
                 self.lbg.append(0)
@@ -1113,8 +1599,8 @@ class opt_out(data_out):
 
         # Measurement constraints
         for i in range(self.y.shape[0]):
-            for ti in range(self.t_int):
-                self.g.append(self.y[i, ti] - ca.dot(self.fwd[i, :].T, (self.x_pos[:, ti] - self.x_neg[:, ti])))
+            for ti in range(self.t_size):
+                self.g.append(self.yp[i, ti] - ca.dot(self.fwd[i, :].T, (self.x_pos[:, ti] - self.x_neg[:, ti])))
                 self.lbg.append(0)
                 self.ubg.append(0)
 
@@ -1148,7 +1634,7 @@ class opt_out(data_out):
             # Background
             tmp_pos = 0
             tmp_neg = 0
-            for jb in range(self.t_int):
+            for jb in range(self.t_size):
                 tmp_pos += self.x_pos[j, jb]
                 tmp_neg += self.x_neg[j, jb]
             self.g.append(tmp_pos*(1 - self.m_pos[j]))
@@ -1173,8 +1659,9 @@ class opt_out(data_out):
             self.minimize_function()
 
             # Results
-            self.xres = (self.res_struct['x_pos'].full() - self.res_struct['x_neg'].full())  \
-                         *(self.res_struct['m_pos'].full() + self.res_struct['m_neg'].full())
+            self.xres = self.project_result(
+                (self.res_struct['x_pos'].full() - self.res_struct['x_neg'].full())  \
+                *(self.res_struct['m_pos'].full() + self.res_struct['m_neg'].full()))
 
     def add_l1_costs_constraints_thesis(self):
         """
@@ -1185,12 +1672,11 @@ class opt_out(data_out):
         @return     { None }
         """
         print self.sigma_value*2
-        for j in range(self.m.shape[0]):
-            self.f += self.sigma_value * (self.m[j])
-            if self.flag_lift_mask:
-                self.g.append(1 - (self.m[j]**2 + (1 - self.m[j])**2)**0.5)
-                self.lbg.append(0)
-                self.ubg.append(0)
+        self.f += self.sp * ca.sum1(self.m)
+        if self.flag_lift_mask:
+            self.g.append(1 - (self.m**2 + (1 - self.m)**2)**0.5)
+            self.lbg.append(ca.DM.zeros(self.x_size))
+            self.ubg.append(ca.DM.zeros(self.x_size))
 
     def add_background_costs_constraints_thesis(self):
         """
@@ -1200,13 +1686,9 @@ class opt_out(data_out):
         
         @return     { None }
         """
-        for b in range(self.m.shape[0]):
-            tmp = 0
-            for tb in range(self.t_int):
-                tmp += self.a[b, tb]**2
-            self.g.append(tmp * (1 - self.m[b]))
-            self.lbg.append(0)
-            self.ubg.append(0)
+        self.g.append(ca.sum2(self.a**2) * (1 - self.m))
+        self.lbg.append(ca.DM.zeros(self.x_size))
+        self.ubg.append(ca.DM.zeros(self.x_size))
 
     def add_tv_mask_costs_constraints_thesis(self):
         """
@@ -1220,12 +1702,10 @@ class opt_out(data_out):
             grad_m = self.cmp_gradient(self.m, False)
         if self.flag_tv == 'fwd':
             grad_m = self.cmp_fwd_diff(self.m, False)
-        for cm in range(self.m.shape[0]):
-            self.g.append(ca.dot(grad_m[:, cm], grad_m[:, cm]))
-            #self.g.append(ca.dot(grad_m[:, cm], grad_m[:, cm]))
-            self.lbg.append(0)
-            # self.ubg.append(3**0.5)
-            self.ubg.append(3)
+        self.g.append(ca.sum1(grad_m**2).T)
+        self.lbg.append(ca.DM.zeros(self.x_size))
+        # self.ubg.append(3**0.5 * ca.DM.ones(self.x_size))
+        self.ubg.append(3 * ca.DM.ones(self.x_size))
 
     def add_smoothness_costs_constraints_thesis(self):
         """
@@ -1239,15 +1719,13 @@ class opt_out(data_out):
         average_sx = self.cmp_fwd_diff(self.s[:, 0], True)[0, :]
         average_sy = self.cmp_fwd_diff(self.s[:, 1], True)[1, :]
         average_sz = self.cmp_fwd_diff(self.s[:, 2], True)[2, :]
-        for tb in range(self.t_int):
+        average_s = average_mask * ca.vertcat(average_sx, average_sy,
+                                              average_sz)
+        for tb in range(self.t_size):
             tmp = self.cmp_fwd_diff(self.a[:, tb], False)
-            for b in range(self.x_size):
-                average_s = ca.vertcat(average_mask[0, b] * average_sx[b],
-                                       average_mask[1, b] * average_sy[b],
-                                       average_mask[2, b] * average_sz[b])
-                self.g.append(ca.dot(average_s, tmp[:, b])**2)
-                self.lbg.append(0)
-                self.ubg.append(0)
+            self.g.append((ca.sum1(average_s * tmp)**2).T)
+            self.lbg.append(ca.DM.zeros(self.x_size))
+            self.ubg.append(ca.DM.zeros(self.x_size))
 
     def add_s_magnitude_costs_constraints_thesis(self):
         """
@@ -1257,10 +1735,23 @@ class opt_out(data_out):
         
         @return     { None }
         """
-        for b in range(self.x_size):
-            self.g.append(ca.dot(self.s[b, :], self.s[b, :]))
-            self.lbg.append(1)
-            self.ubg.append(1)
+        self.g.append(ca.sum2(self.s**2))
+        self.lbg.append(ca.DM.ones(self.x_size))
+        self.ubg.append(ca.DM.ones(self.x_size))
+
+    def get_time_course(self, a):
+        """
+        @brief      Time samples of a source variable, fitted temporal
+                    components are projected back to the t_int samples
+        
+        @param      self  The optimization object
+        @param      a     The variable (x_size x t_size)
+        
+        @return     { Expression (x_size x t_int) }
+        """
+        if self.pca is None:
+            return a
+        return ca.mtimes(a, ca.DM(self.pca['components']))
 
     def add_temporal_smoothness_constraints(self):
         """
@@ -1270,12 +1761,13 @@ class opt_out(data_out):
         
         @return     { None }
         """
-        for ts in range(self.t_size):
-            for tx in range(self.x_size):
-                if ts != self.t_size-1:
-                    self.g.append((self.a[tx, ts+1]-self.a[tx, ts])**2)
-                    self.lbg.append(0)
-                    self.ubg.append(20)
+        a = self.get_time_course(self.a)
+        n_t = a.shape[1]
+        if n_t > 1:
+            n_g = self.x_size * (n_t - 1)
+            self.g.append(ca.vec((a[:, 1:] - a[:, :-1])**2))
+            self.lbg.append(ca.DM.zeros(n_g))
+            self.ubg.append(20 * ca.DM.ones(n_g))
 
     def add_total_charge_constraints(self):
         """
@@ -1285,10 +1777,10 @@ class opt_out(data_out):
         
         @return     { None }
         """
-        for ts in range(self.t_size):
-            self.g.append(sum([self.a[:, ts]]))
-            self.lbg.append(0)
-            self.ubg.append(20)
+        a = self.get_time_course(self.a)
+        self.g.append(ca.sum1(a).T)
+        self.lbg.append(ca.DM.zeros(a.shape[1]))
+        self.ubg.append(20 * ca.DM.ones(a.shape[1]))
 
     def add_min_norm(self):
         """
@@ -1298,8 +1790,7 @@ class opt_out(data_out):
         
         @return     { description_of_the_return_value }
         """
-        for ts in range(self.t_size):
-            self.f += ca.dot(self.a[:, ts], self.a[:, ts])
+        self.f += ca.sumsqr(self.a)
             
     def add_s_smooth_costs_constraints_thesis(self):
         """
@@ -1314,12 +1805,11 @@ class opt_out(data_out):
         grad_y = self.cmp_fwd_diff(self.s[:, 1], False)
         grad_z = self.cmp_fwd_diff(self.s[:, 2], False)
         average_mask = self.cmp_fwd_diff(self.m, True)
-        for b in range(self.s.shape[0]):
-            self.g.append(average_mask[0, b] * ca.dot(grad_x[:, b], grad_x[:, b]) +
-                          average_mask[1, b] * ca.dot(grad_y[:, b], grad_y[:, b]) +
-                          average_mask[2, b] * ca.dot(grad_z[:, b], grad_z[:, b]))
-            self.lbg.append(0)
-            self.ubg.append(self.p_dyn)
+        self.g.append((average_mask[0, :] * ca.sum1(grad_x**2) +
+                       average_mask[1, :] * ca.sum1(grad_y**2) +
+                       average_mask[2, :] * ca.sum1(grad_z**2)).T)
+        self.lbg.append(ca.DM.zeros(self.x_size))
+        self.ubg.append(self.p_dyn * ca.DM.ones(self.x_size))
 
     def solve_ipopt_multi_measurement_thesis(self):
         """
@@ -1329,6 +1819,7 @@ class opt_out(data_out):
         
         @return     { None }
         """
+        self.apply_screening()
         self.set_optimization_variables_thesis()
         t0 = time.time()
         self.add_data_costs_constraints_thesis()
@@ -1350,7 +1841,7 @@ class opt_out(data_out):
             save_this['opts'] = self.opt_opt
             self.write_with_pickle(save_this)
             self.write_casadi_structure(self.res_struct)
-        self.xres = self.res_struct['a'].full()
+        self.xres = self.get_result()
         self.sres = self.res_struct['s'].full()
 
     def set_optimization_variables_only_mask(self):
@@ -1361,7 +1852,7 @@ class opt_out(data_out):
         
         @return     { None }
         """
-        self.w = struct_symMX([entry("a", shape=(self.x_size, self.t_int)),
+        self.w = struct_symMX([entry("a", shape=(self.x_size, self.t_size)),
                                entry("m", shape=(self.x_size)),
                                # entry("ys", shape=(self.y.shape)),
                                ])
@@ -1385,6 +1876,7 @@ class opt_out(data_out):
         
         @return     { None }
         """
+        self.apply_screening()
         self.set_optimization_variables_only_mask()
         t0 = time.time()
         if self.flag_background:
@@ -1411,59 +1903,363 @@ class opt_out(data_out):
             save_this['opts'] = self.opt_opt
             self.write_with_pickle(save_this)
             self.write_casadi_structure(self.res_struct)
-        self.xres = self.res_struct['a'].full() * self.res_struct['m'].full()
+        self.xres = self.get_result()
 
-    def get_ground_truth(self, method = 'shephard'):
+    def cmp_lipschitz(self):
         """
-        @brief      Get the ground truth.
+        @brief      Lipschitz constant of the gradient of the data term
+                    ||y - fwd x||^2, i.e. 2 ||fwd||_2^2
+        
+        @param      self  The optimization object
+        
+        @return     { Lipschitz constant }
+        """
+        if self.lipschitz is None:
+            self.lipschitz = 2 * np.linalg.norm(self.fwd_matrix, 2) ** 2
+        return self.lipschitz
+
+    def cmp_penalty(self, x, p_penalty='l1'):
+        """
+        @brief      Penalty of the convex methods: 'l1' is the element-wise
+                    L1 norm (2p) and 'ridge' the sum of squares (slack, whose
+                    lifting variables bound the squared row norms)
+        
+        @param      self       The optimization object
+        @param      x          The point (x_size x t_size)
+        @param      p_penalty  The penalty
+        
+        @return     { Penalty value }
+        """
+        if p_penalty == 'ridge':
+            return np.sum(x ** 2)
+        return np.sum(np.abs(x))
+
+    def cmp_prox(self, x, thresh, p_penalty='l1'):
+        """
+        @brief      Proximal operator of thresh times the penalty, see
+                    cmp_penalty
+        
+        @param      self       The optimization object
+        @param      x          The point (x_size x t_size)
+        @param      thresh     The threshold
+        @param      p_penalty  The penalty
+        
+        @return     { Thresholded point }
+        """
+        if p_penalty == 'ridge':
+            return x / (1 + 2 * thresh)
+        return np.sign(x) * np.maximum(np.abs(x) - thresh, 0)
+
+    def cmp_fista_objective(self, x, res, p_penalty='l1'):
+        """
+        @brief      Objective ||y - fwd x||^2 + sigma * penalty(x)
+        
+        @param      self       The optimization object
+        @param      x          The point (x_size x t_size)
+        @param      res        The residual fwd x - y
+        @param      p_penalty  The penalty, see cmp_penalty
+        
+        @return     { Objective value }
+        """
+        return (np.sum(res ** 2) +
+                self.sigma_value * self.cmp_penalty(x, p_penalty))
+
+    def cmp_gap_safe(self, fwd, y, x):
+        """
+        @brief      Gap safe screening test for min ||y - fwd x||^2 +
+                    sigma * ||x||_1. The residual is scaled to a dual
+                    feasible point, the duality gap gives a safe sphere around
+                    the dual optimum and voxels whose constraint cannot be
+                    active on that sphere are zero in every solution.
+        
+        @param      self        The optimization object
+        @param      fwd         The forward matrix (n_el x n_v)
+        @param      y           The measurements (n_el x t_size)
+        @param      x           Any point (n_v x t_size)
+        
+        @return     { (Boolean mask of voxels which may be nonzero,
+                      duality gap) }
+        """
+        # 1/2 ||y - fwd x||^2 + lmbda ||x||_1
+        lmbda = self.sigma_value / 2.
+        res = y - np.dot(fwd, x)
+        corr_norm = np.max(np.abs(np.dot(fwd.T, res)), 1)
+        # no voxels left means x = 0 and theta = res / lmbda
+        scale = max(lmbda, np.max(corr_norm)) if corr_norm.size else lmbda
+        theta = res / scale
+        primal = 0.5 * np.sum(res ** 2) + lmbda * np.sum(np.abs(x))
+        dual = (0.5 * np.sum(y ** 2) -
+                0.5 * lmbda ** 2 * np.sum((theta - y / lmbda) ** 2))
+        gap = max(primal - dual, 0.)
+        radius = (2 * gap) ** 0.5 / lmbda
+        # fwd' theta is corr scaled the same way, active voxels sit on the
+        # boundary at the optimum so keep a margin for rounding
+        theta_norm = corr_norm / scale
+        keep = theta_norm + radius * np.sqrt(np.sum(fwd ** 2, 0)) >= 1 - 1e-6
+        return keep, gap
+
+    def cmp_fista(self, p_iter=None, p_tol=None, p_penalty='l1', x0=None):
+        """
+        @brief      Accelerated proximal gradient (FISTA with adaptive
+                    restart) for min ||y - fwd x||^2 + sigma * penalty(x),
+                    NumPy only. For the L1 penalty the gap safe test removes
+                    voxels which are zero in the solution every p_screen
+                    iterations.
+        
+        @param      self       The optimization object
+        @param      p_iter     Maximum number of iterations, p_fista_iter if
+                               None
+        @param      p_tol      Tolerance on the relative change of x,
+                               p_fista_tol if None
+        @param      p_penalty  The penalty, see cmp_penalty
+        @param      x0         Starting point (x_size x t_size), zero if
+                               None
+        
+        @return     { Solution (x_size x t_size), also self.history }
+        """
+        if p_iter is None:
+            p_iter = self.p_fista_iter
+        if p_tol is None:
+            p_tol = self.p_fista_tol
+        fwd = self.fwd_matrix
+        y = np.asarray(self.y, dtype=float)
+        step = 1. / self.cmp_lipschitz()
+        active = np.arange(fwd.shape[1])
+        if x0 is None:
+            x = np.zeros((self.fwd_matrix.shape[1], self.t_size))
+        else:
+            x = np.asarray(x0, dtype=float)
+        z = x
+        fx = np.dot(fwd, x)
+        fz = fx
+        tk = 1.
+        self.history = {'objective': [], 'change': [], 'gap': [],
+                        'n_active': [], 'converged': False}
+        for it in range(p_iter):
+            if self.p_screen and p_penalty == 'l1' and \
+                    it % self.p_screen == 0:
+                keep, gap = self.cmp_gap_safe(fwd, y, x)
+                self.history['gap'].append(gap)
+                if not keep.all():
+                    active = active[keep]
+                    fwd = fwd[:, keep]
+                    x, z = x[keep], z[keep]
+                    fx, fz = np.dot(fwd, x), np.dot(fwd, z)
+                self.history['n_active'].append(active.shape[0])
+                if active.shape[0] == 0:
+                    self.history['converged'] = True
+                    break
+            grad = 2 * np.dot(fwd.T, fz - y)
+            x_new = self.cmp_prox(z - step * grad, step * self.sigma_value,
+                                  p_penalty)
+            fx_new = np.dot(fwd, x_new)
+            dx = x_new - x
+            if np.sum((z - x_new) * dx) > 0:
+                # restart the momentum if it points uphill
+                tk = 1.
+            t_new = (1 + (1 + 4 * tk ** 2) ** 0.5) / 2
+            # z and fwd z are extrapolated together
+            z = x_new + ((tk - 1) / t_new) * dx
+            fz = fx_new + ((tk - 1) / t_new) * (fx_new - fx)
+            change = np.linalg.norm(dx) / max(np.linalg.norm(x_new), 1e-300)
+            x, fx = x_new, fx_new
+            tk = t_new
+            self.history['objective'].append(self.cmp_fista_objective(
+                x, fx - y, p_penalty))
+            self.history['change'].append(change)
+            if change < p_tol:
+                self.history['converged'] = True
+                break
+        self.history['n_iter'] = it + 1
+        xres = np.zeros((self.fwd_matrix.shape[1], self.t_size))
+        xres[active] = x
+        return xres
+
+    def solve_fista(self, p_iter=None, p_tol=None, x0=None):
+        """
+        @brief      NumPy solver for the convex methods, see cmp_fista. 2p
+                    is solved with the element-wise L1 penalty and slack with
+                    its sum of squared row norms ('ridge'). mask is not
+                    convex and has no FISTA counterpart.
+        
+        @param      self    The optimization object
+        @param      p_iter  Maximum number of iterations, p_fista_iter if None
+        @param      p_tol   Tolerance on the relative change of x,
+                            p_fista_tol if None
+        @param      x0      Starting point (x_size x t_size), zero if None
+        
+        @return     { None }
+        """
+        t0 = time.time()
+        p_penalty = {'2p': 'l1', 'slack': 'ridge'}[self.method]
+        x = self.cmp_fista(p_iter, p_tol, p_penalty, x0)
+        t1 = time.time()
+        print "FISTA: %d iterations in %.3f seconds" % (
+            self.history['n_iter'], t1 - t0)
+        # same keys as the IPOPT statistics
+        if self.history['converged']:
+            status = 'Solve_Succeeded'
+        else:
+            status = 'Maximum_Iterations_Exceeded'
+        self.stats = {'iter_count': self.history['n_iter'],
+                      'return_status': status}
+        self.xres = self.project_result(x)
+
+    def apply_screening(self):
+        """
+        @brief      Removes the voxels which the gap safe test proves to be
+                    inactive from the forward matrix before the NLP is built,
+                    the test runs on a short FISTA solve. Only 2p is screened,
+                    the test is exact for its L1 penalty but would remove
+                    nonzero voxels of the other models (slack is a ridge
+                    penalty). Not used with TV, whose operators need the full
+                    grid, nor in parametric mode. x_size is zero if every
+                    voxel is removed.
+        
+        @param      self  The optimization object
+        
+        @return     { None }
+        """
+        self.screen = None
+        self.x_size = self.fwd_matrix.shape[1]
+        self.fwd = ca.MX(self.fwd_matrix)
+        if not self.flag_screen or self.method != '2p' or \
+                self.flag_parametric or self.flag_tv != 'none':
+            return
+        t0 = time.time()
+        x = self.cmp_fista(self.p_screen_iter, 0., 'l1')
+        keep = self.cmp_gap_safe(self.fwd_matrix, np.asarray(self.y, float),
+                                 x)[0]
+        self.screen = keep
+        self.x_size = int(keep.sum())
+        self.fwd = ca.MX(self.fwd_matrix[:, keep])
+        print "Screening kept %d of %d voxels in %.3f seconds" % (
+            self.x_size, keep.shape[0], time.time() - t0)
+
+    def get_ground_truth(self, method='shephard', t_ind=None, t_int=None):
+        """
+        @brief      Get the ground truth, the CSD of the cell segments
+                    interpolated to the voxels. 'shephard' averages the
+                    p_gt_knn nearest segments of every voxel with inverse
+                    squared distance weights (all segments if None),
+                    'modified' averages the segments inside every voxel the
+                    same way. Only the time window is read from lazily
+                    loaded data. The result is cached for the last window
+                    until the voxels change.
         
         @param      self    The optimization object
         @param      method  The method
+        @param      t_ind   First time point, the whole recording if None
+        @param      t_int   Number of time points
         
         @return     Ground truth.
         """
-        data = self.data
-        # mask reconstruction volume
-        vx, vy, vz = self.voxels
-        rx, ry, rz = vx, vy, vz
-        vx, vy, vz = vx.flatten(), vy.flatten(), vz.flatten()
-        voxel_width = self.options['p_vres'] / 2.
-        vx_min, vy_min, vz_min = vx - voxel_width, vy - voxel_width, vz - voxel_width
-        vx_max, vy_max, vz_max = vx + voxel_width, vy + voxel_width, vz + voxel_width
-        # result
-        xmin, xmax = np.min(vx), np.max(vx)
-        ymin, ymax = np.min(vy), np.max(vy)
-        zmin, zmax = np.min(vz), np.max(vz)
-        ind_cell = ((xmin <= data.cell_pos[:, 0]) & (xmax >= data.cell_pos[:, 0]) &
-                    (ymin <= data.cell_pos[:, 1]) & (ymax >= data.cell_pos[:, 1]) &
-                    (zmin <= data.cell_pos[:, 2]) & (zmax >= data.cell_pos[:, 2]))
-        vis_cell_pos = data.cell_pos[ind_cell.nonzero()[0], :]
-        vis_cell_csd = data.cell_csd[ind_cell.nonzero()[0], :]
-        ind_in_vox = []
-        for iv in range(vx_min.shape[0]):
-            ind_in_vox.append((vx_min[iv] <= vis_cell_pos[:, 0]) & (vis_cell_pos[:, 0] <= vx_max[iv]) &
-                              (vy_min[iv] <= vis_cell_pos[:, 1]) & (vy_max[iv] >= vis_cell_pos[:, 1]) &
-                              (vz_min[iv] <= vis_cell_pos[:, 2]) & (vz_max[iv] >= vis_cell_pos[:, 2]))
-        ind_in_vox = np.array(ind_in_vox)
-        nnz_ind_in_vox = np.nonzero(np.sum(ind_in_vox, 1))[0]
-        vox_csd = np.zeros((vx.shape[0], vis_cell_csd.shape[1]))
-        vox_pt = np.zeros(vx.shape[0])
-        if method == 'shephard':
-            vox_cell_pos = vis_cell_pos
-            vox_cell_csd = vis_cell_csd
-            vox_pos = np.array([vx, vy, vz]).T
-            vox_dis = 1./cdist(vox_cell_pos, vox_pos)**2
-            vox_csd = np.dot(vox_dis.T, vox_cell_csd) / np.sum(vox_dis.T, axis = 1).reshape(vox_dis.T.shape[0], 1)
-        elif method == 'modified':
-            for ivv in nnz_ind_in_vox:
-                vox_cell_pos = vis_cell_pos[ind_in_vox[ivv, :]]
-                vox_cell_csd = vis_cell_csd[ind_in_vox[ivv, :]]
-                vox_pos = [vx[ivv], vy[ivv], vz[ivv]]
-                vox_dis = 1. / \
-                    np.sum(np.abs(vox_cell_pos - vox_pos)**2, axis=-1)
-                vox_csd[ivv,:] = np.dot(vox_cell_csd[:, :],
-                                      vox_dis) / np.sum(vox_dis)
-        return [vox_csd]
+        key = (method, self.p_gt_knn, t_ind, t_int)
+        if key not in self.gt_cache:
+            if t_ind is None:
+                window = slice(None)
+            else:
+                window = slice(t_ind, t_ind + t_int)
+            # other windows of the method are dropped
+            self.gt_cache = dict((k, v) for k, v in self.gt_cache.items()
+                                 if k[:2] != key[:2])
+            data = self.data
+            vox_pos = self.voxels.reshape(3, -1).T
+            # segments within the extent of the voxel centers
+            ind_cell = np.all((vox_pos.min(0) <= data.cell_pos) &
+                              (vox_pos.max(0) >= data.cell_pos), 1)
+            vis_cell_pos = data.cell_pos[ind_cell.nonzero()[0], :]
+            vis_cell_csd = data.cell_csd[ind_cell.nonzero()[0], window]
+            if method == 'shephard':
+                vox_csd = self.cmp_shephard(vox_pos, vis_cell_pos,
+                                            vis_cell_csd)
+            elif method == 'modified':
+                vox_csd = self.cmp_voxel_average(vox_pos, vis_cell_pos,
+                                                 vis_cell_csd)
+            self.gt_cache[key] = [vox_csd]
+        return self.gt_cache[key]
+
+    def cmp_shephard(self, vox_pos, cell_pos, cell_csd):
+        """
+        @brief      Inverse squared distance (Shepard) interpolation of the
+                    segment CSD to the voxels, over the p_gt_knn nearest
+                    segments as a sparse matrix or over all segments in
+                    blocks of p_vblock voxels
+        
+        @param      self      The optimization object
+        @param      vox_pos   The voxel positions (n_v x 3)
+        @param      cell_pos  The segment positions (n_c x 3)
+        @param      cell_csd  The segment CSD (n_c x n_t)
+        
+        @return     { Voxel CSD (n_v x n_t) }
+        """
+        n_v, n_c = vox_pos.shape[0], cell_pos.shape[0]
+        if n_c == 0:
+            return np.zeros((n_v, cell_csd.shape[1]))
+        if self.p_gt_knn is None or self.p_gt_knn >= n_c:
+            p_vblock = self.options['p_vblock']
+            vox_csd = np.empty((n_v, cell_csd.shape[1]))
+            for v in range(0, n_v, p_vblock):
+                dist = cdist(vox_pos[v:v + p_vblock], cell_pos)
+                weights = 1. / np.maximum(dist, 1e-12) ** 2
+                vox_csd[v:v + p_vblock] = (np.dot(weights, cell_csd) /
+                                           np.sum(weights, 1)[:, None])
+            return vox_csd
+        dist, ind = cKDTree(cell_pos).query(vox_pos, self.p_gt_knn)
+        dist, ind = dist.reshape(n_v, -1), ind.reshape(n_v, -1)
+        weights = 1. / np.maximum(dist, 1e-12) ** 2
+        weights /= np.sum(weights, 1)[:, None]
+        weights = coo_matrix((weights.flatten(),
+                              (np.repeat(np.arange(n_v), self.p_gt_knn),
+                               ind.flatten())), shape=(n_v, n_c)).tocsr()
+        return weights.dot(cell_csd)
+
+    def cmp_voxel_average(self, vox_pos, cell_pos, cell_csd):
+        """
+        @brief      Inverse squared distance average of the segments inside
+                    every voxel. Segments are binned with integer grid
+                    arithmetic (on the finest level of an octree), voxels
+                    without segments are zero.
+        
+        @param      self      The optimization object
+        @param      vox_pos   The voxel positions (n_v x 3)
+        @param      cell_pos  The segment positions (n_c x 3)
+        @param      cell_csd  The segment CSD (n_c x n_t)
+        
+        @return     { Voxel CSD (n_v x n_t) }
+        """
+        n_v, n_c = vox_pos.shape[0], cell_pos.shape[0]
+        if self.octree is not None or self.grid is not None:
+            if self.octree is not None:
+                origin = self.octree['origin']
+                spacing = self.octree['spacing']
+                shape = self.octree['shape']
+            else:
+                origin = vox_pos[0]
+                spacing = np.array(self.grid['spacing'])
+                shape = self.grid['shape']
+            ind = np.round((cell_pos - origin) / spacing).astype(int)
+            inside = np.all((ind >= 0) & (ind < np.array(shape)), 1)
+            vox = np.ravel_multi_index(ind[inside].T, shape)
+            if self.octree is not None:
+                # grid points outside the leaves are labelled -1
+                label = -np.ones(n_c, dtype=int)
+                label[inside] = self.octree['labels'].flatten()[vox]
+                inside = label >= 0
+                vox = label[inside]
+        else:
+            # nearest voxel, inside if within its p_vres box
+            vox = cKDTree(vox_pos).query(cell_pos)[1]
+            inside = np.all(np.abs(cell_pos - vox_pos[vox]) <=
+                            self.options['p_vres'] / 2., 1)
+            vox = vox[inside]
+        cell = np.nonzero(inside)[0]
+        dist = np.sum((cell_pos[cell] - vox_pos[vox]) ** 2, 1)
+        weights = coo_matrix((1. / np.maximum(dist, 1e-24), (vox, cell)),
+                             shape=(n_v, n_c)).tocsr()
+        norm = np.asarray(weights.sum(1)).flatten()
+        weights = diags(1. / np.where(norm > 0, norm, 1)).dot(weights)
+        return weights.dot(cell_csd)
 
     def get_kcsd_estimate(self):
         """
@@ -1487,3 +2283,37 @@ class opt_out(data_out):
         k.estimate_pots()
         k.estimate_csd()
         k.plot_all()
+
+
+batch_opt = None
+
+
+def init_batch_worker(data, options):
+    """
+    @brief      Pool initializer of opt_out.solve_batch, builds the
+                optimization object of this worker process
+    
+    @param      data     The data object
+    @param      options  The optimization options
+    
+    @return     { None }
+    """
+    global batch_opt
+    batch_opt = opt_out(data, **options)
+
+
+def solve_batch_window(t_ind):
+    """
+    @brief      Localizes one window in a worker of opt_out.solve_batch, the
+                first window builds the solver, the others re-solve it
+    
+    @param      t_ind  First time point of the window
+    
+    @return     { (t_ind, xres) }
+    """
+    if hasattr(batch_opt, 'res'):
+        batch_opt.resolve(t_ind)
+    else:
+        batch_opt.set_measurements(t_ind)
+        batch_opt.get_solve_function()()
+    return t_ind, batch_opt.xres
@@ -57,6 +57,13 @@ class visualize(object):
         if kwargs['loc'].method == 'thesis':
             self.sres = kwargs['loc'].sres
         self.voxels = kwargs['loc'].voxels
+        if getattr(kwargs['loc'], 'octree', None) is not None:
+            # octree leaves are shown on the finest grid
+            self.voxels = kwargs['loc'].get_regular_voxels()
+            self.xres = kwargs['loc'].get_regular_values(self.xres)
+            self.gt = kwargs['loc'].get_regular_values(self.gt)
+            if kwargs['loc'].method == 'thesis':
+                self.sres = kwargs['loc'].get_regular_values(self.sres)
         # self.t_ind = args[1].t_ind
         self.t_ind = kwargs['loc'].t_ind
         # self.norm = visualize.MidpointNormalize(midpoint=0)
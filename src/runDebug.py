@@ -83,6 +83,7 @@ optimization_options = {'p_vres':10, 'p_jlen':0, 'p_erad': 10,
                         'sigma': float(p_sparse),
                         'flag_depthweighted': bool(int(p_norm)),
                         'flag_parallel': False,
+                        'flag_cache': True,
                         'datafile_name': dfname,
                         'flag_lift_mask': False,
                         'flag_data_mask': False,